@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Latency of the first request of a fresh Connection, cold and prewarmed.
+
+Sends unsigned HEAD requests to the API host, which cost no credits.
+Usage: PYTHONPATH=. python benchmarks/first_request.py [--rounds 5] [--url URL]
+"""
+import argparse
+import statistics
+import time
+
+import btcde
+
+
+def first_request(url, prewarm, dns_ttl):
+    conn = btcde.Connection('', '', ssl_verify=True, pool_size=2, dns_ttl=dns_ttl)
+    conn.apihost = url
+    if prewarm:
+        conn.prewarm()
+    start = time.perf_counter()
+    conn.session.head(url, verify=True)
+    elapsed = time.perf_counter() - start
+    conn.session.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--url', default='https://api.bitcoin.de')
+    args = parser.parse_args()
+    for name, prewarm, dns_ttl in (('cold', False, None),
+                                   ('prewarmed', True, 300)):
+        times = [first_request(args.url, prewarm, dns_ttl)
+                 for _ in range(args.rounds)]
+        print('{:10} median {:7.1f} ms  min {:7.1f} ms  max {:7.1f} ms'.format(
+            name, statistics.median(times) * 1000, min(times) * 1000,
+            max(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Request preparation and decode throughput from 1 to N threads.
+
+Runs without network access. Compare the output of a regular and a
+free-threaded (no GIL) CPython build.
+Usage: PYTHONPATH=. python benchmarks/thread_scaling.py [--threads 8] [--seconds 2]
+"""
+import argparse
+import sys
+import threading
+import time
+
+import requests
+
+import btcde
+
+with open('tests/resources/showOrderbookCompact.json', 'rb') as f:
+    ORDERBOOK = f.read()
+
+
+def prepare(conn):
+    params = {'type': 'buy', 'only_kyc_full': 1, 'payment_option': 1}
+    p = btcde.ParameterBuilder(conn.ORDERBOOK_PARAMS, params,
+                               conn.apibase + 'btceur/orderbook')
+    conn.set_header(p.url, 'GET', p.encoded_string)
+
+
+def decode(conn):
+    r = requests.Response()
+    r.status_code = 200
+    r._content = ORDERBOOK
+    conn.decode_response('GET', conn.apibase + 'btceur/orderbook/compact', r)
+
+
+def throughput(work, conn, threads, seconds):
+    counts = [0] * threads
+    stop = threading.Event()
+    barrier = threading.Barrier(threads + 1)
+
+    def run(index):
+        barrier.wait()
+        while not stop.is_set():
+            for _ in range(100):
+                work(conn)
+            counts[index] += 100
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=2)
+    args = parser.parse_args()
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('Python {} GIL {}'.format(sys.version.split()[0],
+                                    'enabled' if gil else 'disabled'))
+    benchmarks = (('prepare', prepare, False), ('decode', decode, False),
+                  ('decode fingerprinted', decode, True))
+    for name, work, fingerprint in benchmarks:
+        conn = btcde.Connection('api_key', 'api_secret', fingerprint=fingerprint)
+        counts = [2 ** i for i in range(args.threads.bit_length())]
+        if counts[-1] != args.threads:
+            counts.append(args.threads)
+        base = None
+        for threads in counts:
+            rate = throughput(work, conn, threads, args.seconds)
+            base = base or rate
+            print('{:22} {:3} threads {:10.0f}/s  x{:.2f}'.format(
+                name, threads, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,51 @@
 """API Wrapper for Bitcoin.de Trading API."""
 
 import requests
+import requests.adapters
 import time
 import hmac
 import hashlib
 import logging
 import decimal
 import inspect
+import json
+import re
+import gzip
+import collections
+import threading
+import concurrent.futures
+import heapq
+import datetime
+import mmap
+import struct
+import os
+import socket
+import sqlite3
+import pickle
+import atexit
+import bisect
+import copy
+import csv
+import itertools
+import sys
+import argparse
 
 from urllib.parse import urlencode
 
-logging.basicConfig()
 log = logging.getLogger(__name__)
 requests_log = logging.getLogger("requests.packages.urllib3")
 requests_log.propagate = True
 
 __version__ = '4.1'
 
+# Public market data endpoints which are usually polled and eligible for
+# fingerprinting, matched against the end of the request path.
+POLLED_ENDPOINTS = ('/orderbook', '/orderbook/compact', '/rates',
+                    '/trades/history')
+CREDITS_PATTERN = re.compile(rb'"credits"\s*:\s*(-?\d+)')
+# order, trade and address ids in API paths
+ID_SEGMENT = re.compile(r'/(orders|trades|details|address)/(?!public(/|$)|history$)[^/]+')
+
 class ParameterBuilder(object):
     '''To verify given parameters for API.'''
     def __init__(self, avail_params, given_params, uri):
@@ -84,6 +113,44 @@ class ParameterBuilder(object):
                    'buy_diamondshop', 'kickback',
                    'outgoing_fee_voluntary']
 
+class PolledResult(dict):
+    '''Decoded response of a fingerprinted endpoint.
+
+    unchanged is True if the body was identical to the previous response
+    for the same URL (apart from credits) and decoding was skipped. Nested
+    values are shared with the previous result and should not be modified.'''
+    unchanged = False
+
+
+class CancelReport(dict):
+    '''deleteOrder result per order_id of Connection.cancel_all().
+
+    complete is False if listing the pending orders failed on some page,
+    then only the orders listed before were deleted.'''
+    complete = True
+
+
+def endpoint_template(url):
+    """Path of url with ids replaced, to key per-endpoint statistics."""
+    return ID_SEGMENT.sub(r'/\1/{id}', url.split('?')[0])
+
+
+def format_datetime(timestamp):
+    """Format a unix timestamp as RFC 3339 date used by the API."""
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(timestamp))
+
+
+def parse_datetime(value):
+    """Parse a RFC 3339 date of the API to a unix timestamp."""
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def close_response(future):
+    """Done callback releasing the response of a discarded request."""
+    if future.exception() is None:
+        future.result().close()
+
+
 def HandleRequestsException(e):
     """Handle Exception from request."""
     log.warning(e)
@@ -93,81 +160,648 @@ def HandleAPIErrors(r):
     """To handle Errors from BTCDE API."""
     valid_status_codes = [200, 201, 204]
     if r.status_code not in valid_status_codes:
-        content = r.json()
-        errors = content.get('errors')
-        log.warning('API Error Code: {}'.format(str(errors[0]['code'])))
-        log.warning('API Error Message: {}'.format(errors[0]['message']))
+        errors = parse_errors(r) or [{}]
+        log.warning('API Error Code: {}'.format(str(errors[0].get('code'))))
+        log.warning('API Error Message: {}'.format(errors[0].get('message')))
         log.warning('API Error URL: {}'.format(r.url))
         return False
     else:
         return True
 
+
+def parse_errors(r):
+    """List of error dicts in a response body, empty if it is not JSON."""
+    try:
+        errors = json.loads(r.content).get('errors')
+    except (ValueError, AttributeError):
+        return []
+    if not isinstance(errors, list):
+        return []
+    return [e for e in errors if isinstance(e, dict)]
+
+
+class APIError(Exception):
+    """Base of the errors raised by a Connection in strict mode.
+
+    errors holds the error dicts of the response and codes their codes.
+    retry tells if sending the same request again can succeed, after
+    retry_after seconds (the Retry-After header if the API sent one)."""
+    retry = False
+    retry_after = None
+
+    def __init__(self, message, status_code=None, errors=(), url=None,
+                 retry_after=None):
+        super(APIError, self).__init__(message)
+        self.status_code = status_code
+        self.errors = list(errors)
+        self.codes = [e.get('code') for e in self.errors]
+        self.url = url
+        if retry_after is not None:
+            self.retry_after = retry_after
+
+
+class CreditsExhausted(APIError):
+    """Not enough credits left for the request."""
+    retry = True
+    retry_after = 10
+
+
+class NonceError(APIError):
+    """The nonce was rejected, a new request gets a new one."""
+    retry = True
+    retry_after = 0
+
+
+class AuthenticationError(APIError):
+    """API key, signature or permission not accepted."""
+
+
+class ValidationError(APIError, ValueError):
+    """The request was rejected for its parameters."""
+
+
+class TransientError(APIError):
+    """The request did not get through (network, timeout, open circuit)."""
+    retry = True
+    retry_after = 1
+
+
+class ServerError(APIError):
+    """The API failed with a server error."""
+    retry = True
+    retry_after = 5
+
+
+def classify_error(r):
+    """Return the APIError subclass instance for an error response."""
+    errors = parse_errors(r)
+    messages = ' '.join(str(e.get('message', '')) for e in errors).lower()
+    if r.status_code == 429 or 'credits' in messages:
+        cls = CreditsExhausted
+    elif 'nonce' in messages:
+        cls = NonceError
+    elif (r.status_code in (401, 403) or 'signature' in messages
+          or 'api key' in messages):
+        cls = AuthenticationError
+    elif r.status_code >= 500:
+        cls = ServerError
+    elif r.status_code in (408, 425):
+        cls = TransientError
+    else:
+        cls = ValidationError
+    retry_after = r.headers.get('Retry-After')
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+    message = '; '.join(str(e.get('message')) for e in errors) or r.reason
+    return cls('{} {}: {}'.format(r.status_code, r.url, message),
+               status_code=r.status_code, errors=errors, url=r.url,
+               retry_after=retry_after)
+
+class LatencyTracker(object):
+    '''Keep the most recent response times of an endpoint.'''
+    def __init__(self, size=200, min_samples=20):
+        self.samples = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percentile):
+        """Latency at percentile (0-1), None until min_samples are known."""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)]
+
+
+class CircuitBreaker(object):
+    '''Fail fast on an endpoint after repeated failures.
+
+    After threshold consecutive failures the breaker opens and rejects
+    calls for timeout seconds, then lets a single trial call through.'''
+    def __init__(self, threshold=5, timeout=30):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.timeout:
+                # half open, further calls wait for the trial's outcome
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+
+class DNSCache(object):
+    """Cache of resolved addresses, each kept for ttl seconds."""
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Return an address of host, resolving it at most once per ttl."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((host, port))
+        if entry is None or now - entry[0] >= self.ttl:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            entry = (now, infos[0][4][0])
+            with self.lock:
+                self.entries[(host, port)] = entry
+        return entry[1]
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+
+class CachedDNSConnection(object):
+    """Mixin for urllib3 connections resolving through dns_cache."""
+    dns_cache = None
+
+    def _new_conn(self):
+        # urllib3 only resolves _dns_host, server_hostname stays self.host
+        host = self._dns_host
+        self._dns_host = self.dns_cache.resolve(host, self.port)
+        try:
+            return super(CachedDNSConnection, self)._new_conn()
+        except Exception:
+            self.dns_cache.forget(host, self.port)
+            raise
+        finally:
+            self._dns_host = host
+
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose new sockets connect to addresses from a DNSCache.
+
+    The host name is still used for SNI and certificate checks."""
+    def __init__(self, dns_cache=None, **args):
+        self.dns_cache = dns_cache
+        super(PooledAdapter, self).__init__(**args)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        if self.dns_cache is None:
+            return
+        classes = {}
+        for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items():
+            connection_class = type('Cached' + pool_class.ConnectionCls.__name__,
+                                    (CachedDNSConnection, pool_class.ConnectionCls),
+                                    {'dns_cache': self.dns_cache})
+            classes[scheme] = type('Cached' + pool_class.__name__, (pool_class,),
+                                   {'ConnectionCls': connection_class})
+        self.poolmanager.pool_classes_by_scheme = classes
+
+
 class Connection(object):
     """To provide connection credentials to the trading API"""
-    def __init__(self, api_key, api_secret, ssl_verify=False):
+    ORDERBOOK_PARAMS = ['type', 'trading_pair', 'amount_currency_to_trade', 'price',
+                        'order_requirements_fullfilled',
+                        'only_kyc_full', 'only_express_orders', 'payment_option',
+                        'sepa_option', 'only_same_bankgroup', 'only_same_bic',
+                        'seat_of_bank', 'page_size']
+    # fingerprinted URLs kept, least recently used are dropped
+    max_fingerprints = 256
+
+    def __init__(self, api_key, api_secret, ssl_verify=False, fingerprint=False,
+                 recorder=None, hedge_percentile=None, min_credits=0,
+                 breaker_threshold=None, breaker_timeout=30, pool_size=10,
+                 journal=None, session=None, dns_ttl=None, strict=False):
         self.api_key = api_key
         self.api_secret = api_secret
         # set initial self.nonce
         self.nonce = int(time.time() * 1000000)
+        self.nonce_lock = threading.Lock()
         # Bitcoin.de API URI
         self.apihost = 'https://api.bitcoin.de'
         self.apiversion = 'v4'
         self.apibase = f'{self.apihost}/{self.apiversion}/'
         self.ssl_verify = ssl_verify # avoid warnings for ssl-cert
+        # skip decoding of unchanged bodies on POLLED_ENDPOINTS
+        self.fingerprint = fingerprint
+        self.fingerprints = collections.OrderedDict()
+        self.change_listeners = []
+        # MarketDataRecorder to capture raw market data responses
+        self.recorder = recorder
+        # credits left as reported by the last response
+        self.credits = None
+        self.min_credits = min_credits
+        # duplicate slow GET requests after this latency percentile
+        self.hedge_percentile = hedge_percentile
+        self.latencies = {}
+        self.executor = None
+        # guards lazily created executors and per endpoint state
+        self.lock = threading.Lock()
+        # per endpoint CircuitBreaker, disabled without breaker_threshold
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.breakers = {}
+        # keep-alive connections shared by all (concurrent) requests,
+        # or by several connections if a session is passed in
+        self.pool_size = pool_size
+        if session is None:
+            session = requests.Session()
+            # resolve apihost once per dns_ttl seconds instead of per socket
+            dns_cache = DNSCache(dns_ttl) if dns_ttl else None
+            adapter = PooledAdapter(dns_cache=dns_cache, pool_connections=1,
+                                    pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+        self.session = session
+        self.keepalive = None
+        # separate workers for order writes, never queued behind reads
+        self.write_executor = None
+        # WriteJournal of all POST and DELETE requests
+        self.journal = journal
+        # optional RequestScheduler taking over the write workers
+        self.scheduler = None
+        # raise APIError subclasses instead of logging and returning {}
+        self.strict = strict
 
-    def build_hmac_sign(self, md5string, method, url):
-        hmac_data = '#'.join([method, url, self.api_key, str(self.nonce), md5string])
+    def build_hmac_sign(self, md5string, method, url, nonce=None):
+        if nonce is None:
+            nonce = self.nonce
+        hmac_data = '#'.join([method, url, self.api_key, str(nonce), md5string])
         hmac_signed = hmac.new(bytearray(self.api_secret.encode()), msg=hmac_data.encode(), digestmod=hashlib.sha256).hexdigest()
         return hmac_signed
 
     def set_header(self, url, method, encoded_string):
-        # raise self.nonce before using
-        self.nonce = int(time.time() * 1000000)
+        # raise self.nonce before using, strictly increasing across threads
+        with self.nonce_lock:
+            nonce = max(int(time.time() * 1000000), self.nonce + 1)
+            self.nonce = nonce
         if method == 'POST':
             md5_encoded_query_string = hashlib.md5(encoded_string.encode()).hexdigest()
         else:
             md5_encoded_query_string = hashlib.md5(b'').hexdigest()
         hmac_signed = self.build_hmac_sign(md5_encoded_query_string,
-                                           method, url)
+                                           method, url, nonce)
         # set header
         header = {'content-type':
                   'application/x-www-form-urlencoded; charset=utf-8',
                   'X-API-KEY': self.api_key,
-                  'X-API-NONCE': str(self.nonce),
+                  'X-API-NONCE': str(nonce),
                   'X-API-SIGNATURE': hmac_signed }
         return header
 
     def send_request(self, url, method, header, encoded_string):
         if method == 'GET':
-            r = requests.get(url, headers=(header),
-                             stream=True, verify=self.ssl_verify)
+            r = self.session.get(url, headers=(header),
+                                 stream=True, verify=self.ssl_verify)
         elif method == 'POST':
-            r = requests.post(url, headers=(header), data=encoded_string,
-                              stream=True, verify=self.ssl_verify)
+            r = self.session.post(url, headers=(header), data=encoded_string,
+                                  stream=True, verify=self.ssl_verify)
         elif method == 'DELETE':
-            r = requests.delete(url, headers=(header),
-                                stream=True, verify=self.ssl_verify)
+            r = self.session.delete(url, headers=(header),
+                                    stream=True, verify=self.ssl_verify)
         return r
 
-    def APIConnect(self, method, params):
-        """Transform Parameters to URL"""
+    def signed_request(self, method, params):
+        """Sign with a fresh nonce, send and track the latency."""
         header = self.set_header(params.url, method,
                                  params.encoded_string)
         log.debug('Set Header: {}'.format(header))
+        entry = None
+        if self.journal is not None and method != 'GET':
+            entry = self.journal.intent(method, params.url, header['X-API-NONCE'],
+                                        params.encoded_string)
+        start = time.monotonic()
+        r = self.send_request(params.url, method, header,
+                              params.encoded_string)
+        self.get_latency(endpoint_template(params.url)).add(time.monotonic() - start)
+        if entry is not None:
+            self.journal.outcome(entry, r.status_code, r.content)
+        return r
+
+    def has_credits(self, cost=1):
+        return self.credits is None or self.credits - cost >= self.min_credits
+
+    def send_hedged(self, method, params):
+        """Send a duplicate request if the first one is slow, first answer wins."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix='btcde-hedge')
+        endpoint = endpoint_template(params.url)
+        delay = self.get_latency(endpoint).percentile(self.hedge_percentile)
+        first = self.executor.submit(self.signed_request, method, params)
+        if delay is None:
+            return first.result()
+        done, _ = concurrent.futures.wait([first], timeout=delay)
+        if done or not self.has_credits():
+            return first.result()
+        log.debug('Hedging request to {}'.format(endpoint))
+        second = self.executor.submit(self.signed_request, method, params)
+        pending = {first, second}
+        winner = None
+        while pending and winner is None:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                # prefer a valid answer, e.g. over a rejected lower nonce
+                if (future.exception() is None
+                        and future.result().status_code < 400):
+                    winner = future
+                    break
+        if winner is None:
+            winner = future
+        # give the loser's socket back to the pool, also if it is late
+        loser = second if winner is first else first
+        loser.add_done_callback(close_response)
+        return winner.result()
+
+    def prewarm(self, count=None, ping=False):
+        """Open pooled connections to apihost before they are needed.
+
+        Makes sure count (default pool_size) idle sockets have finished DNS
+        resolution, TCP and TLS handshake, reconnecting dropped ones. With
+        ping, sockets still open send a HEAD request to stay in use. Returns
+        the number of connected sockets."""
+        count = min(count or self.pool_size, self.pool_size)
+        adapter = self.session.get_adapter(self.apihost)
+        pool = adapter.poolmanager.connection_from_url(self.apihost)
+        connections = [pool._get_conn() for _ in range(count)]
+
+        def warm(connection):
+            try:
+                # is_connected is urllib3 2.x, older versions only have sock
+                connected = getattr(connection, 'is_connected',
+                                    getattr(connection, 'sock', None) is not None)
+                if not connected:
+                    connection.connect()
+                elif ping:
+                    connection.request('HEAD', '/')
+                    connection.getresponse().read()
+                return True
+            except Exception as e:
+                log.warning('Connection to {} failed: {}'.format(self.apihost, e))
+                connection.close()
+                return False
+
+        with concurrent.futures.ThreadPoolExecutor(
+                count, thread_name_prefix='btcde-prewarm') as executor:
+            warmed = list(executor.map(warm, connections))
+        for connection in connections:
+            pool._put_conn(connection)
+        return sum(warmed)
+
+    def start_keepalive(self, interval=30, count=None):
+        """Prewarm and ping the pool every interval seconds in a thread."""
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.prewarm(count, ping=True)
+        self.keepalive = (stop, threading.Thread(target=run, daemon=True,
+                                                 name='btcde-keepalive'))
+        self.keepalive[1].start()
+
+    def stop_keepalive(self):
+        if self.keepalive is not None:
+            stop, thread = self.keepalive
+            stop.set()
+            thread.join()
+            self.keepalive = None
+
+    def get_latency(self, endpoint):
+        tracker = self.latencies.get(endpoint)
+        if tracker is None:
+            with self.lock:
+                tracker = self.latencies.setdefault(endpoint, LatencyTracker())
+        return tracker
+
+    def get_breaker(self, endpoint):
+        if self.breaker_threshold is None:
+            return None
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    endpoint, CircuitBreaker(self.breaker_threshold,
+                                             self.breaker_timeout))
+        return breaker
+
+    def APIConnect(self, method, params):
+        """Transform Parameters to URL"""
+        breaker = self.get_breaker(endpoint_template(params.url))
+        if breaker is not None and not breaker.allow():
+            if self.strict:
+                raise TransientError('Circuit open: {}'.format(params.url),
+                                     url=params.url,
+                                     retry_after=self.breaker_timeout)
+            log.warning('Circuit open, skipped: {}'.format(params.url))
+            return {}
         try:
-            r = self.send_request(params.url, method, header,
-                                  params.encoded_string)
+            if self.hedge_percentile is not None and method == 'GET':
+                r = self.send_hedged(method, params)
+            else:
+                r = self.signed_request(method, params)
+            if breaker is not None:
+                # server errors and exhausted credits count as failures
+                breaker.record(r.status_code < 500 and r.status_code != 429)
+            if self.recorder is not None:
+                self.recorder.record(method, params.url, r)
             # Handle API Errors
+            if self.strict and r.status_code not in (200, 201, 204):
+                raise classify_error(r)
             if HandleAPIErrors(r):
                 # get results
-                result = r.json(parse_float=decimal.Decimal)
+                try:
+                    result = self.decode_response(method, params.url, r)
+                except ValueError as e:
+                    # body is not JSON, with or without fingerprinting
+                    if breaker is not None:
+                        breaker.record(False)
+                    if self.strict:
+                        raise ServerError('Invalid JSON: {}'.format(params.url),
+                                          status_code=r.status_code,
+                                          url=params.url) from e
+                    log.warning('Invalid JSON response: {}'.format(params.url))
+                    result = {}
             else:
                 result = {}
+        except APIError:
+            raise
         except requests.exceptions.RequestException as e:
+            if breaker is not None:
+                breaker.record(False)
+            if self.strict:
+                raise TransientError(str(e), url=params.url) from e
             HandleRequestsException(e)
             result = {}
+        if isinstance(result.get('credits'), int):
+            self.credits = result['credits']
         return result
 
+    def decode_response(self, method, url, r):
+        """Decode the JSON body, reusing the last result if it is unchanged."""
+        if not (self.fingerprint and method == 'GET'
+                and url.split('?')[0].endswith(POLLED_ENDPOINTS)
+                and 'since_tid=' not in url):
+            # since_tid polls are incremental, each URL is asked only once
+            return r.json(parse_float=decimal.Decimal)
+        body = r.content
+        match = CREDITS_PATTERN.search(body)
+        if match:
+            digest = hashlib.blake2b(body[:match.start()] + body[match.end():],
+                                     digest_size=16).digest()
+        else:
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+        with self.lock:
+            previous = self.fingerprints.get(url)
+            if previous is not None:
+                self.fingerprints.move_to_end(url)
+        if previous is not None and previous[0] == digest:
+            result = PolledResult(previous[1])
+            result.unchanged = True
+            if match:
+                result['credits'] = int(match.group(1))
+            return result
+        result = PolledResult(json.loads(body, parse_float=decimal.Decimal))
+        with self.lock:
+            self.fingerprints[url] = (digest, result)
+            self.fingerprints.move_to_end(url)
+            while len(self.fingerprints) > self.max_fingerprints:
+                self.fingerprints.popitem(last=False)
+        for callback in self.change_listeners:
+            callback(url, result)
+        return result
+
+    def snapshot_state(self):
+        with self.lock:
+            fingerprints = dict(self.fingerprints)
+        return {'nonce': self.nonce, 'credits': self.credits,
+                'fingerprints': fingerprints}
+
+    def restore_state(self, state):
+        with self.nonce_lock:
+            self.nonce = max(self.nonce, state['nonce'])
+        self.credits = state['credits']
+        with self.lock:
+            self.fingerprints.update(state['fingerprints'])
+            while len(self.fingerprints) > self.max_fingerprints:
+                self.fingerprints.popitem(last=False)
+
+    def on_change(self, callback):
+        """Call callback(url, result) whenever a fingerprinted body changes."""
+        self.change_listeners.append(callback)
+        return callback
+
+    def submit_write(self, func, *args, **kwargs):
+        if self.scheduler is not None:
+            return self.scheduler.submit(func.__name__, *args, **kwargs)
+        with self.lock:
+            if self.write_executor is None:
+                self.write_executor = concurrent.futures.ThreadPoolExecutor(
+                    self.pool_size, thread_name_prefix='btcde-write')
+        return self.write_executor.submit(func, *args, **kwargs)
+
+    def delete_orders(self, orders):
+        """Delete (order_id, trading_pair) pairs in parallel.
+
+        Returns a dict of order_id to the deleteOrder result, which is empty
+        for orders that could not be deleted."""
+        futures = {order_id: self.submit_write(self.deleteOrder, order_id, trading_pair)
+                   for order_id, trading_pair in orders}
+        report = {}
+        for order_id, future in futures.items():
+            try:
+                report[order_id] = future.result()
+            except Exception as e:
+                HandleRequestsException(e)
+                report[order_id] = {}
+        return report
+
+    def cancel_all(self, trading_pair=None, type=None):
+        """Delete all pending own orders, optionally filtered, in parallel.
+
+        Returns a CancelReport, not complete if the listing failed. In
+        strict mode the listing error is raised instead."""
+        params = {'state': 0}
+        if trading_pair is not None:
+            params['trading_pair'] = trading_pair
+        if type is not None:
+            params['type'] = type
+        orders = []
+        complete = True
+        page, last = 1, 1
+        while page <= last:
+            result = self.showMyOrders(page=page, **params)
+            if not result:
+                log.warning('Listing pending orders failed on page {}, '
+                            'not all orders are deleted'.format(page))
+                complete = False
+                break
+            orders.extend((o['order_id'], o.get('trading_pair', trading_pair))
+                          for o in result.get('orders', []))
+            last = result.get('page', {}).get('last', 1)
+            page += 1
+        report = CancelReport(self.delete_orders(orders))
+        report.complete = complete
+        return report
+
+    def replace_orders(self, replacements):
+        """Delete and create orders concurrently in one round trip.
+
+        replacements is a list of dicts with order_id, trading_pair,
+        order_type, max_amount_currency_to_trade, price and optional
+        createOrder parameters. Returns a list of dicts with the deleted
+        and created results. The new order is not held back if the old one
+        can not be deleted."""
+        pending = []
+        for replacement in replacements:
+            args = dict(replacement)
+            order_id = args.pop('order_id')
+            trading_pair = args.pop('trading_pair')
+            order_type = args.pop('order_type')
+            amount = args.pop('max_amount_currency_to_trade')
+            price = args.pop('price')
+            pending.append((order_id,
+                            self.submit_write(self.deleteOrder, order_id, trading_pair),
+                            self.submit_write(self.createOrder, order_type, trading_pair,
+                                              amount, price, **args)))
+        report = []
+        for order_id, deleted, created in pending:
+            entry = {'order_id': order_id}
+            for key, future in (('deleted', deleted), ('created', created)):
+                try:
+                    entry[key] = future.result()
+                except Exception as e:
+                    HandleRequestsException(e)
+                    entry[key] = {}
+            report.append(entry)
+        return report
+
+    def replace_order(self, order_id, trading_pair, order_type,
+                      max_amount_currency_to_trade, price, **args):
+        """Replace an order, deleting and creating concurrently."""
+        replacement = {'order_id': order_id, 'trading_pair': trading_pair,
+                       'order_type': order_type, 'price': price,
+                       'max_amount_currency_to_trade': max_amount_currency_to_trade}
+        replacement.update(args)
+        return self.replace_orders([replacement])[0]
+
     def addToAddressPool(self, currency, address, **args):
         """Add address to pool"""
         uri = f'{self.apibase}{currency}/address'
@@ -199,12 +833,7 @@ class Connection(object):
         uri = f'{self.apibase}{trading_pair}/orderbook'
         params = {'type': order_type}
         params.update(args)
-        avail_params = ['type', 'trading_pair', 'amount_currency_to_trade', 'price',
-                        'order_requirements_fullfilled',
-                        'only_kyc_full', 'only_express_orders', 'payment_option',
-                        'sepa_option', 'only_same_bankgroup', 'only_same_bic',
-                        'seat_of_bank', 'page_size']
-        p = ParameterBuilder(avail_params, params, uri)
+        p = ParameterBuilder(self.ORDERBOOK_PARAMS, params, uri)
         return self.APIConnect('GET', p)
 
     def showOrderDetails(self, trading_pair, order_id):
@@ -416,4 +1045,2592 @@ class Connection(object):
         """Show permissions that are allowed for used API key"""
         uri = f'{self.apibase}permissions'
         p = ParameterBuilder({}, {}, uri)
-        return self.APIConnect('GET', p)
\ No newline at end of file
+        return self.APIConnect('GET', p)
+
+class RequestDropped(TransientError):
+    """A scheduled request was shed because its queue was full or its deadline passed."""
+
+
+class ReplayExhausted(EOFError):
+    """No more recorded responses for the requested URL."""
+
+
+class MarketDataRecorder(object):
+    """Append raw market data responses to a gzip compressed capture file.
+
+    Every record is one JSON line with the receive time, method, URL, status
+    code and raw body. Reopening a file appends a new gzip member, which is
+    read back transparently by MarketDataReplay."""
+    def __init__(self, path, endpoints=POLLED_ENDPOINTS, flush_every=100):
+        self.path = path
+        self.endpoints = endpoints
+        self.flush_every = flush_every
+        self.pending = 0
+        self.file = gzip.open(path, 'ab')
+        self.lock = threading.Lock()
+
+    def record(self, method, url, r):
+        if method != 'GET' or not url.split('?')[0].endswith(self.endpoints):
+            return
+        entry = {'time': time.time(), 'method': method, 'url': url,
+                 'status': r.status_code,
+                 'body': r.content.decode('utf-8', 'replace')}
+        line = json.dumps(entry).encode() + b'\n'
+        with self.lock:
+            self.file.write(line)
+            self.pending += 1
+            if self.pending >= self.flush_every:
+                self.file.flush()
+                self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_capture(path):
+    """Yield the records of a capture file written by MarketDataRecorder."""
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class MarketDataReplay(Connection):
+    """Connection which answers requests from a capture file.
+
+    Each call returns the next recorded response for the same URL. With
+    speed=None responses are returned as fast as possible, otherwise the
+    recorded timing is reproduced, scaled by speed (2 is twice as fast)."""
+    def __init__(self, path, speed=None, api_key='replay', api_secret='replay',
+                 **kwargs):
+        super().__init__(api_key, api_secret, **kwargs)
+        self.speed = speed
+        self.records = read_capture(path)
+        self.buffered = collections.defaultdict(collections.deque)
+        self.first_time = None
+        self.start_time = None
+
+    def next_record(self, url):
+        queue = self.buffered.get(url)
+        if queue:
+            return queue.popleft()
+        for record in self.records:
+            if record['url'] == url:
+                return record
+            self.buffered[record['url']].append(record)
+        raise ReplayExhausted(url)
+
+    def wait_for(self, record):
+        if self.first_time is None:
+            self.first_time = record['time']
+            self.start_time = time.monotonic()
+        if self.speed:
+            due = (record['time'] - self.first_time) / self.speed
+            delay = due - (time.monotonic() - self.start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+    def send_request(self, url, method, header, encoded_string):
+        record = self.next_record(url)
+        self.wait_for(record)
+        r = requests.Response()
+        r.status_code = record['status']
+        r.url = url
+        r.encoding = 'utf-8'
+        r._content = record['body'].encode()
+        return r
+
+
+def run_parameter_sweep(func, param_sets, processes=None):
+    """Run func(params) for every parameter set in parallel processes.
+
+    func has to be a picklable module level function, e.g. one which builds
+    a SimulatedExchange, feeds it a capture and returns the strategy result."""
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(func, param_sets))
+
+
+class SimulatedExchange(object):
+    """Simulate own orders and trades against historical order books.
+
+    createOrder, deleteOrder, executeTrade, showMyOrders and showMyTrades
+    share the signatures of Connection. Books are fed with
+    apply_orderbook_compact (resting own orders are matched against the
+    opposite side) and apply_orderbook (offers which can be taken with
+    executeTrade)."""
+    def __init__(self, credits=20):
+        self.credits = credits
+        self.clock = time.time()
+        self.sequence = 0
+        self.orders = {}
+        self.trades = []
+        # own pending orders per (trading_pair, type), sorted by price
+        self.resting = collections.defaultdict(list)
+        # public offers per (trading_pair, order_id) from showOrderbook
+        self.offers = {}
+
+    def next_id(self, prefix):
+        self.sequence += 1
+        return f'{prefix}{self.sequence:06d}'
+
+    def timestamp(self):
+        return format_datetime(self.clock)
+
+    def response(self, **data):
+        data.update({'errors': [], 'credits': self.credits})
+        return data
+
+    def error(self, code, message):
+        # mirror Connection, which logs API errors and returns an empty dict
+        log.warning('API Error Code: {}'.format(code))
+        log.warning('API Error Message: {}'.format(message))
+        return {}
+
+    def add_trade(self, trading_pair, order_type, amount, price, order_id):
+        trade = {'trade_id': self.next_id('T'), 'trading_pair': trading_pair,
+                 'type': order_type, 'amount': amount, 'price': price,
+                 'volume': amount * price, 'state': 1, 'order_id': order_id,
+                 'created_at': self.timestamp(),
+                 'successfully_finished_at': self.timestamp()}
+        self.trades.append(trade)
+        return trade
+
+    def createOrder(self, order_type, trading_pair, max_amount_currency_to_trade, price, **args):
+        """Create a new simulated Order."""
+        avail_params = ['type', 'max_amount_currency_to_trade', 'price',
+                        'min_amount_currency_to_trade', 'end_datetime',
+                        'new_order_for_remaining_amount', 'trading_pair',
+                        'min_trust_level', 'only_kyc_full', 'payment_option',
+                        'sepa_option', 'seat_of_bank']
+        params = {'type': order_type, 'trading_pair': trading_pair}
+        params.update(args)
+        ParameterBuilder(avail_params, params, '')
+        order = {'order_id': self.next_id('O'), 'trading_pair': trading_pair,
+                 'type': order_type,
+                 'max_amount': decimal.Decimal(str(max_amount_currency_to_trade)),
+                 'min_amount': decimal.Decimal(str(args.get('min_amount_currency_to_trade', 0))),
+                 'price': decimal.Decimal(str(price)), 'state': 0,
+                 'created_at': self.timestamp()}
+        self.orders[order['order_id']] = order
+        resting = self.resting[(trading_pair, order_type)]
+        resting.append(order)
+        resting.sort(key=lambda o: o['price'], reverse=order_type == 'buy')
+        return self.response(order_id=order['order_id'])
+
+    def deleteOrder(self, order_id, trading_pair):
+        """Delete a simulated Order."""
+        order = self.orders.get(order_id)
+        if order is None or order['state'] != 0 or order['trading_pair'] != trading_pair:
+            return self.error(13, 'Order not found')
+        order['state'] = -1
+        self.resting[(trading_pair, order['type'])].remove(order)
+        return self.response()
+
+    def executeTrade(self, trading_pair, order_id, order_type, amount, payment_option=2):
+        """Buy/Sell on a specific offer of the last applied orderbook."""
+        offer = self.offers.get((trading_pair, order_id))
+        amount = decimal.Decimal(str(amount))
+        if offer is None:
+            return self.error(13, 'Order not found')
+        if not offer['min_amount'] <= amount <= offer['max_amount']:
+            return self.error(42, 'Amount out of range')
+        offer['max_amount'] -= amount
+        if offer['max_amount'] <= 0:
+            del self.offers[(trading_pair, order_id)]
+        trade = self.add_trade(trading_pair, order_type, amount,
+                               offer['price'], order_id)
+        return self.response(trade_id=trade['trade_id'])
+
+    def filter(self, items, args):
+        for key in ('type', 'trading_pair', 'state'):
+            if key in args:
+                items = [i for i in items if i[key] == args[key]]
+        return items
+
+    def showMyOrders(self, **args):
+        """Query and Filter own simulated Orders."""
+        avail_params = ['type', 'trading_pair', 'state',
+                        'date_start', 'date_end', 'page']
+        ParameterBuilder(avail_params, args, '')
+        orders = self.filter(list(self.orders.values()), args)
+        return self.response(orders=orders, page={'current': 1, 'last': 1})
+
+    def showMyTrades(self, **args):
+        """Query and Filter on simulated Trades."""
+        avail_params = ['type', 'trading_pair', 'state',
+                        'only_trades_with_action_for_payment_or_transfer_required',
+                        'payment_method', 'date_start', 'date_end', 'page']
+        ParameterBuilder(avail_params, args, '')
+        trades = self.filter(self.trades, args)
+        return self.response(trades=trades, page={'current': 1, 'last': 1})
+
+    def apply_orderbook(self, trading_pair, result, timestamp=None):
+        """Replace the offers of trading_pair by a showOrderbook result."""
+        if timestamp is not None:
+            self.clock = timestamp
+        for key in [k for k in self.offers if k[0] == trading_pair]:
+            del self.offers[key]
+        for offer in result.get('orders', []):
+            self.offers[(trading_pair, offer['order_id'])] = {
+                'price': decimal.Decimal(str(offer['price'])),
+                'min_amount': decimal.Decimal(str(offer['min_amount'])),
+                'max_amount': decimal.Decimal(str(offer['max_amount']))}
+
+    def apply_orderbook_compact(self, trading_pair, result, timestamp=None):
+        """Match own pending orders against a showOrderbookCompact result.
+
+        Each level can only be consumed once per snapshot; both lists are
+        walked once in price order."""
+        if timestamp is not None:
+            self.clock = timestamp
+        orders = result.get('orders', {})
+        self.match(trading_pair, 'buy', orders.get('asks', []),
+                   lambda level, order: level <= order)
+        self.match(trading_pair, 'sell', orders.get('bids', []),
+                   lambda level, order: level >= order)
+
+    def match(self, trading_pair, order_type, levels, crosses):
+        resting = self.resting[(trading_pair, order_type)]
+        if not resting or not levels:
+            return
+        levels = sorted(((decimal.Decimal(str(level['price'])),
+                          decimal.Decimal(str(level['amount']))) for level in levels),
+                        reverse=order_type == 'sell')
+        i = 0
+        available = levels[0][1]
+        for order in list(resting):
+            while i < len(levels) and crosses(levels[i][0], order['price']):
+                fill = min(available, order['max_amount'])
+                if fill > 0:
+                    self.add_trade(trading_pair, order_type, fill,
+                                   order['price'], order['order_id'])
+                    order['max_amount'] -= fill
+                    available -= fill
+                if order['max_amount'] <= 0:
+                    order['state'] = 1
+                    resting.remove(order)
+                    break
+                i += 1
+                if i < len(levels):
+                    available = levels[i][1]
+            else:
+                break
+
+    def feed_capture(self, path):
+        """Apply the order books of a capture file, yielding after each one."""
+        for record in read_capture(path):
+            if record['status'] != 200:
+                continue
+            parts = record['url'].split('?')[0].split('/')
+            result = json.loads(record['body'], parse_float=decimal.Decimal)
+            if parts[-1] == 'compact':
+                self.apply_orderbook_compact(parts[-3], result, record['time'])
+            elif parts[-1] == 'orderbook':
+                self.apply_orderbook(parts[-2], result, record['time'])
+            else:
+                continue
+            yield record
+
+
+class Subscription(object):
+    """Polling state of one endpoint and trading pair in a PollingScheduler."""
+    def __init__(self, trading_pair, endpoint, min_interval, max_interval,
+                 callback=None, queue=None, loop=None):
+        self.trading_pair = trading_pair
+        self.endpoint = endpoint
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.callback = callback
+        self.queue = queue
+        self.loop = loop
+        self.last = None
+        self.since_tid = None
+        self.active = True
+
+    def deliver(self, result):
+        if self.callback is not None:
+            self.callback(self, result)
+        if self.queue is not None:
+            if self.loop is not None:
+                # asyncio.Queue, hand over to its event loop
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, (self, result))
+            else:
+                self.queue.put_nowait((self, result))
+
+
+class PollingScheduler(object):
+    """Poll market data endpoints with intervals adapted to their change rate.
+
+    The interval of a subscription halves when its data changed and grows
+    by backoff otherwise, always within min_interval and max_interval. While
+    the credits reported by the connection are below credit_reserve all
+    intervals are stretched. Calls are spread to be at least spacing
+    seconds apart. Changed results are delivered to the subscription's
+    callback and/or queue (queue.Queue, or asyncio.Queue together with its
+    loop)."""
+    ENDPOINTS = ['showOrderbookCompact', 'showRates', 'showPublicTradeHistory']
+
+    def __init__(self, conn, spacing=0.05, backoff=1.5, credit_reserve=10):
+        self.conn = conn
+        self.spacing = spacing
+        self.backoff = backoff
+        self.credit_reserve = credit_reserve
+        self.heap = []
+        self.counter = 0
+        self.last_call = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def subscribe(self, trading_pair, endpoint, min_interval=1, max_interval=60,
+                  callback=None, queue=None, loop=None):
+        if endpoint not in self.ENDPOINTS:
+            raise ValueError("{} is not any of {}".format(
+                endpoint, ', '.join(self.ENDPOINTS)))
+        ParameterBuilder({}, {}, '').verify_keys_and_values(
+            ['trading_pair'], {'trading_pair': trading_pair})
+        sub = Subscription(trading_pair, endpoint, min_interval, max_interval,
+                           callback, queue, loop)
+        with self.condition:
+            # stagger first calls to avoid a burst
+            self.schedule(sub, time.monotonic() + len(self.heap) * self.spacing)
+            self.condition.notify()
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.active = False
+
+    def schedule(self, sub, due):
+        self.counter += 1
+        heapq.heappush(self.heap, (due, self.counter, sub))
+
+    def fetch(self, sub):
+        method = getattr(self.conn, sub.endpoint)
+        if sub.endpoint == 'showPublicTradeHistory' and sub.since_tid is not None:
+            return method(sub.trading_pair, since_tid=sub.since_tid)
+        return method(sub.trading_pair)
+
+    def has_changed(self, sub, result):
+        if sub.endpoint == 'showPublicTradeHistory':
+            trades = result.get('trades')
+            if trades:
+                sub.since_tid = max(t['tid'] for t in trades)
+            return bool(trades)
+        if isinstance(result, PolledResult):
+            return not result.unchanged
+        data = {k: v for k, v in result.items() if k != 'credits'}
+        changed = data != sub.last
+        sub.last = data
+        return changed
+
+    def poll(self, sub):
+        """Poll a subscription once, deliver changes and adapt its interval."""
+        result = self.fetch(sub)
+        self.last_call = time.monotonic()
+        if result and self.has_changed(sub, result):
+            sub.interval = max(sub.min_interval, sub.interval / 2)
+            sub.deliver(result)
+        else:
+            sub.interval = min(sub.max_interval, sub.interval * self.backoff)
+        credits = self.conn.credits
+        interval = sub.interval
+        if credits is not None and credits < self.credit_reserve:
+            interval = min(sub.max_interval,
+                           interval * self.credit_reserve / max(credits, 1))
+        return self.last_call + interval
+
+    def run_pending(self):
+        """Poll every due subscription, return seconds until the next one."""
+        while self.heap:
+            with self.condition:
+                due, _, sub = self.heap[0]
+                now = time.monotonic()
+                wait = max(due, self.last_call + self.spacing) - now
+                if wait > 0:
+                    return wait
+                heapq.heappop(self.heap)
+            if not sub.active:
+                continue
+            try:
+                next_due = self.poll(sub)
+            except Exception as e:
+                log.warning('Polling {} {} failed: {}'.format(
+                    sub.endpoint, sub.trading_pair, e))
+                next_due = time.monotonic() + sub.max_interval
+            with self.condition:
+                self.schedule(sub, next_due)
+        return None
+
+    def run(self):
+        while self.running:
+            wait = self.run_pending()
+            with self.condition:
+                if self.running:
+                    self.condition.wait(wait)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='btcde-poller',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class OrderTracker(object):
+    """Track own orders locally, indexed by id, trading pair and state.
+
+    createOrder and deleteOrder are forwarded to the connection and
+    recorded. reconcile() only asks showMyOrders for pending orders created
+    since the oldest locally open order, so open_orders() can be answered
+    without paging through all own orders."""
+    def __init__(self, conn, overlap=60):
+        self.conn = conn
+        self.overlap = overlap
+        self.orders = {}
+        self.by_pair = collections.defaultdict(set)
+        self.by_state = collections.defaultdict(set)
+        self.last_sync = None
+        self.lock = threading.Lock()
+
+    def update(self, order_id, **fields):
+        with self.lock:
+            order = self.orders.setdefault(order_id, {'order_id': order_id})
+            if 'state' in order:
+                self.by_state[order['state']].discard(order_id)
+            order.update(fields)
+            self.by_pair[order['trading_pair']].add(order_id)
+            self.by_state[order['state']].add(order_id)
+        return order
+
+    def createOrder(self, order_type, trading_pair, max_amount_currency_to_trade, price, **args):
+        """Create a new Order and track it."""
+        result = self.conn.createOrder(order_type, trading_pair,
+                                       max_amount_currency_to_trade, price, **args)
+        if result.get('order_id'):
+            self.update(result['order_id'], trading_pair=trading_pair,
+                        type=order_type, max_amount=max_amount_currency_to_trade,
+                        price=price, state=0, created_at=time.time())
+        return result
+
+    def deleteOrder(self, order_id, trading_pair):
+        """Delete an Order and mark it as cancelled."""
+        result = self.conn.deleteOrder(order_id, trading_pair)
+        if result:
+            self.update(order_id, trading_pair=trading_pair, state=-1)
+        return result
+
+    def cancel_all(self, trading_pair=None, type=None):
+        """Delete all locally open orders in parallel, without listing them."""
+        orders = [(o['order_id'], o['trading_pair'])
+                  for o in self.open_orders(trading_pair)
+                  if type is None or o.get('type') == type]
+        report = self.conn.delete_orders(orders)
+        for (order_id, pair) in orders:
+            if report[order_id]:
+                self.update(order_id, trading_pair=pair, state=-1)
+        return report
+
+    def snapshot_state(self):
+        with self.lock:
+            orders = {i: dict(order) for i, order in self.orders.items()}
+        return {'orders': orders, 'last_sync': self.last_sync}
+
+    def restore_state(self, state):
+        for order_id, order in state['orders'].items():
+            self.update(order_id, **{k: v for k, v in order.items() if k != 'order_id'})
+        self.last_sync = state['last_sync']
+
+    def get(self, order_id):
+        return self.orders.get(order_id)
+
+    def open_orders(self, trading_pair=None):
+        """Pending orders, optionally only of trading_pair."""
+        with self.lock:
+            ids = self.by_state[0]
+            if trading_pair is not None:
+                ids = ids & self.by_pair[trading_pair]
+            return [self.orders[i] for i in ids]
+
+    def fetch_pending(self, date_start=None):
+        orders = []
+        args = {}
+        if date_start is not None:
+            args['date_start'] = format_datetime(date_start)
+        page, last = 1, 1
+        while page <= last:
+            result = self.conn.showMyOrders(state=0, page=page, **args)
+            if not result:
+                return None
+            orders.extend(result.get('orders', []))
+            last = result.get('page', {}).get('last', 1)
+            page += 1
+        return orders
+
+    def reconcile(self):
+        """Sync with pending orders created since the oldest open order.
+
+        The first sync lists all pending orders. Untracked pending orders
+        are added. Tracked open orders which are no longer pending are
+        looked up once with showMyOrderDetails. Returns False if the orders
+        could not be fetched."""
+        now = time.time()
+        date_start = None
+        if self.last_sync is not None:
+            with self.lock:
+                starts = [self.orders[i]['created_at'] for i in self.by_state[0]]
+            date_start = min(starts + [self.last_sync]) - self.overlap
+        orders = self.fetch_pending(date_start)
+        if orders is None:
+            return False
+        pending = set()
+        for order in orders:
+            pending.add(order['order_id'])
+            fields = {k: v for k, v in order.items() if k != 'order_id'}
+            fields['created_at'] = parse_datetime(order['created_at'])
+            fields.setdefault('trading_pair', self.orders.get(
+                order['order_id'], {}).get('trading_pair'))
+            self.update(order['order_id'], **fields)
+        with self.lock:
+            missing = list(self.by_state[0] - pending)
+        for order_id in missing:
+            order = self.orders[order_id]
+            details = self.conn.showMyOrderDetails(order['trading_pair'], order_id)
+            if details.get('order'):
+                self.update(order_id, state=details['order']['state'])
+        self.last_sync = now
+        return True
+
+
+class FillPlan(object):
+    """Offers to take for a target amount, as planned by FillPlanner.
+
+    complete is False if the offers can not fill the target, shortfall is
+    the amount missing then."""
+    def __init__(self, order_type, legs, target=None):
+        self.order_type = order_type
+        # (order_id, amount, price) per offer to take
+        self.legs = legs
+        self.amount = sum((leg[1] for leg in legs), decimal.Decimal(0))
+        self.volume = sum((leg[1] * leg[2] for leg in legs), decimal.Decimal(0))
+        self.target = self.amount if target is None else decimal.Decimal(str(target))
+        self.shortfall = self.target - self.amount
+        self.complete = self.shortfall <= 0
+
+    @property
+    def price(self):
+        """Effective (volume weighted) price, None for an empty plan."""
+        return self.volume / self.amount if self.amount else None
+
+    def execute(self, conn, trading_pair, payment_option=2, partial=False):
+        """Send all executeTrade calls in parallel, return the results per order_id.
+
+        An incomplete plan is only executed with partial."""
+        if not self.complete and not partial:
+            log.warning('Plan is {} short of {}, not executed'.format(
+                self.shortfall, self.target))
+            return {}
+        futures = [(order_id, conn.submit_write(conn.executeTrade, trading_pair,
+                                                order_id, self.order_type,
+                                                amount, payment_option))
+                   for order_id, amount, price in self.legs]
+        report = {}
+        for order_id, future in futures:
+            try:
+                report[order_id] = future.result()
+            except Exception as e:
+                HandleRequestsException(e)
+                report[order_id] = {}
+        return report
+
+
+class FillPlanner(object):
+    """Plan the cheapest way to fill an amount from a showOrderbook result.
+
+    The offers are loaded once into columns; plan() masks out offers whose
+    requirements are not met by the own account and walks the rest in price
+    order, respecting the min/max amount of every offer."""
+    max_nodes = 10000
+
+    def __init__(self, orderbook):
+        offers = orderbook.get('orders', [])
+        number = decimal.Decimal
+        self.order_ids = [o['order_id'] for o in offers]
+        self.prices = [number(str(o['price'])) for o in offers]
+        self.min_amounts = [number(str(o['min_amount'])) for o in offers]
+        self.max_amounts = [number(str(o['max_amount'])) for o in offers]
+        requirements = [o.get('order_requirements', {}) for o in offers]
+        levels = ParameterBuilder.TRUST_LEVELS
+        self.min_trust = [levels.index(r['min_trust_level'])
+                          if r.get('min_trust_level') in levels else 0
+                          for r in requirements]
+        self.kyc_full = [bool(r.get('only_kyc_full')) for r in requirements]
+        self.payment_options = [r.get('payment_option', 3) for r in requirements]
+        self.seats = [r.get('seat_of_bank') for r in requirements]
+
+    def eligible(self, trust_level=None, is_kyc_full=None, seat_of_bank=None,
+                 payment_option=None):
+        """Mask of offers that accept an account with the given attributes."""
+        mask = [True] * len(self.order_ids)
+        if trust_level is not None:
+            level = ParameterBuilder.TRUST_LEVELS.index(trust_level)
+            mask = [m and t <= level for m, t in zip(mask, self.min_trust)]
+        if is_kyc_full is not None and not is_kyc_full:
+            mask = [m and not k for m, k in zip(mask, self.kyc_full)]
+        if seat_of_bank is not None:
+            mask = [m and (not s or seat_of_bank in s) for m, s in zip(mask, self.seats)]
+        if payment_option is not None:
+            mask = [m and p in (payment_option, 3)
+                    for m, p in zip(mask, self.payment_options)]
+        return mask
+
+    def plan(self, order_type, amount, **account):
+        """Plan offers to take for amount; account as for eligible().
+
+        Offers are taken best price first. Only when the min_amount of an
+        offer does not fit, other combinations are searched (up to
+        max_nodes steps, skipping those that can not beat the best plan
+        found) so the target is filled whenever the offers allow it. If
+        they do not, the plan filling the most is returned, incomplete."""
+        target = decimal.Decimal(str(amount))
+        mask = self.eligible(**account)
+        candidates = sorted((i for i, ok in enumerate(mask) if ok),
+                            key=self.prices.__getitem__,
+                            reverse=order_type == 'sell')
+        sign = 1 if order_type == 'buy' else -1
+        legs = []
+        blocked = False
+        remaining = target
+        for i in candidates:
+            take = min(remaining, self.max_amounts[i])
+            if take <= 0:
+                break
+            if take < self.min_amounts[i]:
+                blocked = True
+                continue
+            legs.append((self.order_ids[i], take, self.prices[i]))
+            remaining -= take
+        greedy = FillPlan(order_type, legs, target)
+        if not blocked:
+            # best price first is optimal when no min_amount is in the way
+            return greedy
+        best_cost, best_legs = None, None
+        if greedy.complete:
+            best_cost, best_legs = sign * greedy.volume, legs
+
+        def bound(k, chosen, low, base):
+            """Lowest cost of filling the target from a node, None if it can
+            not be filled: the chosen offers above their min amount, then
+            the remaining candidates ignoring their min amount."""
+            cost, rest = base, target - low
+            extras = ((i, self.max_amounts[i] - self.min_amounts[i]) for i in chosen)
+            rests = ((i, self.max_amounts[i]) for i in candidates[k:])
+            for i, extra in itertools.chain(extras, rests):
+                if rest <= 0:
+                    break
+                take = min(rest, extra)
+                cost += sign * take * self.prices[i]
+                rest -= take
+            return cost if rest <= 0 else None
+
+        def allocate(chosen):
+            takes = [self.min_amounts[i] for i in chosen]
+            rest = target - sum(takes)
+            for n, i in enumerate(chosen):
+                extra = min(rest, self.max_amounts[i] - self.min_amounts[i])
+                takes[n] += extra
+                rest -= extra
+            return [(self.order_ids[i], take, self.prices[i])
+                    for i, take in zip(chosen, takes)]
+
+        # depth first over taking or skipping each offer, taking first;
+        # a set of offers fits if its min amounts stay within the target
+        # and its max amounts reach it, then its bound is its cost
+        zero = decimal.Decimal(0)
+        stack = [(0, (), zero, zero, zero)]
+        nodes = 0
+        while stack and nodes < self.max_nodes:
+            k, chosen, low, high, base = stack.pop()
+            nodes += 1
+            cost = bound(k, chosen, low, base)
+            if cost is None or (best_cost is not None and cost >= best_cost):
+                continue
+            if high >= target:
+                best_cost, best_legs = cost, allocate(chosen)
+                continue
+            if k == len(candidates):
+                continue
+            i = candidates[k]
+            stack.append((k + 1, chosen, low, high, base))
+            if low + self.min_amounts[i] <= target:
+                stack.append((k + 1, chosen + (i,), low + self.min_amounts[i],
+                              high + self.max_amounts[i],
+                              base + sign * self.min_amounts[i] * self.prices[i]))
+        if best_legs is not None:
+            return FillPlan(order_type, best_legs, target)
+        return greedy
+
+
+class OrderbookQueryPlanner(object):
+    """Merge concurrent showOrderbook queries into one request.
+
+    Calls to showOrderbook() arriving within window seconds for the same
+    type and pair share a single request. Filters that can be checked
+    on the returned offers (MERGEABLE) are only sent when all queries of the
+    batch use the same value, the rest is applied client-side for every
+    caller. Queries with other differing parameters, or with page_size,
+    are fetched separately."""
+    MERGEABLE = ('only_kyc_full', 'seat_of_bank', 'order_requirements_fullfilled',
+                 'amount_currency_to_trade', 'price')
+
+    def __init__(self, conn, window=0.05):
+        self.conn = conn
+        self.window = window
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def showOrderbook(self, order_type, trading_pair, **args):
+        """As Connection.showOrderbook, merged with concurrent calls."""
+        params = {'type': order_type}
+        params.update(args)
+        ParameterBuilder(self.conn.ORDERBOOK_PARAMS, dict(params), '')
+        # with page_size the server truncates the filtered list, so only
+        # identical queries can share a request
+        merge = 'page_size' not in params
+        fixed = tuple(sorted((k, str(v)) for k, v in params.items()
+                             if k not in self.MERGEABLE or not merge))
+        key = (trading_pair, fixed)
+        future = concurrent.futures.Future()
+        with self.lock:
+            batch = self.batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.batches[key] = []
+            batch.append((args, future))
+        if leader:
+            time.sleep(self.window)
+            with self.lock:
+                del self.batches[key]
+            self.run(order_type, trading_pair, batch)
+        return future.result()
+
+    def run(self, order_type, trading_pair, batch):
+        """Fetch the least restrictive query of a batch, filter per caller."""
+        shared = dict(batch[0][0])
+        for args, _ in batch[1:]:
+            for k in self.MERGEABLE:
+                if k in shared and (k not in args or str(args[k]) != str(shared[k])):
+                    del shared[k]
+        try:
+            r = self.conn.showOrderbook(order_type, trading_pair, **shared)
+            offers = r.get('orders')
+            columns = self.columns(offers) if offers is not None else None
+            for args, future in batch:
+                if offers is None:
+                    future.set_result(r)
+                    continue
+                mask = self.mask(columns, order_type,
+                                 {k: v for k, v in args.items()
+                                  if k in self.MERGEABLE and k not in shared})
+                result = dict(r)
+                result['orders'] = [o for o, ok in zip(offers, mask) if ok]
+                future.set_result(result)
+        except Exception as e:
+            # never leave a waiting caller behind
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    @staticmethod
+    def columns(offers):
+        number = decimal.Decimal
+        partners = [o.get('trading_partner_information', {}) for o in offers]
+        return {'price': [number(str(o['price'])) for o in offers],
+                'min_amount': [number(str(o['min_amount'])) for o in offers],
+                'max_amount': [number(str(o['max_amount'])) for o in offers],
+                'fullfilled': [bool(o.get('order_requirements_fullfilled'))
+                               for o in offers],
+                'kyc_full': [bool(p.get('is_kyc_full')) for p in partners],
+                'seat': [p.get('seat_of_bank') for p in partners]}
+
+    @staticmethod
+    def mask(columns, order_type, filters):
+        """Mask of offers matching filters as the API would apply them."""
+        mask = [True] * len(columns['price'])
+        for k, v in filters.items():
+            if k == 'price':
+                # highest price to buy at, lowest price to sell at
+                limit = decimal.Decimal(str(v))
+                if order_type == 'buy':
+                    mask = [m and p <= limit for m, p in zip(mask, columns['price'])]
+                else:
+                    mask = [m and p >= limit for m, p in zip(mask, columns['price'])]
+            elif k == 'amount_currency_to_trade':
+                amount = decimal.Decimal(str(v))
+                mask = [m and low <= amount <= high for m, low, high
+                        in zip(mask, columns['min_amount'], columns['max_amount'])]
+            elif k == 'seat_of_bank':
+                mask = [m and s == v for m, s in zip(mask, columns['seat'])]
+            elif str(v).lower() in ('0', 'false'):
+                continue
+            elif k == 'only_kyc_full':
+                mask = [m and full for m, full in zip(mask, columns['kyc_full'])]
+            elif k == 'order_requirements_fullfilled':
+                mask = [m and f for m, f in zip(mask, columns['fullfilled'])]
+        return mask
+
+
+def split_trading_pair(trading_pair):
+    """Split a trading pair like 'btcusdt' into base and quote currency."""
+    for quote in ('usdt', 'eur', 'btc'):
+        if trading_pair.endswith(quote) and len(trading_pair) > len(quote):
+            return trading_pair[:-len(quote)], quote
+    raise ValueError("{} is not any of {}".format(
+        trading_pair, ', '.join(ParameterBuilder.TRADING_PAIRS)))
+
+
+class RateGraph(object):
+    """Currency graph of exchange rates with incremental triangle spreads.
+
+    rates[i][j] is the amount of currency j received for one unit of
+    currency i. Every triangle of pairs is precomputed once, so an update
+    of a pair only recomputes the spreads of the triangles using it. A
+    spread above 0 means going round the cycle returns more than it
+    started with (before fees)."""
+    def __init__(self, trading_pairs=None):
+        if trading_pairs is None:
+            trading_pairs = ParameterBuilder.TRADING_PAIRS
+        self.pairs = {pair: split_trading_pair(pair) for pair in trading_pairs}
+        currencies = sorted({c for pair in self.pairs.values() for c in pair})
+        self.index = {c: i for i, c in enumerate(currencies)}
+        self.currencies = currencies
+        size = len(currencies)
+        self.rates = [[0.0] * size for _ in range(size)]
+        for i in range(size):
+            self.rates[i][i] = 1.0
+        self.spreads = {}
+        self.lock = threading.Lock()
+        # cycles (a, b, c) through each pair, in both directions, each
+        # rotated to start at its smallest index so all three pairs of a
+        # triangle share the same keys
+        neighbours = collections.defaultdict(set)
+        for base, quote in self.pairs.values():
+            neighbours[self.index[base]].add(self.index[quote])
+            neighbours[self.index[quote]].add(self.index[base])
+        self.cycles = collections.defaultdict(set)
+        for pair, (base, quote) in self.pairs.items():
+            a, b = self.index[base], self.index[quote]
+            for c in neighbours[a] & neighbours[b]:
+                for cycle in ((a, b, c), (a, c, b)):
+                    start = cycle.index(min(cycle))
+                    self.cycles[pair].add(cycle[start:] + cycle[:start])
+
+    def update(self, trading_pair, bid, ask):
+        """Set best bid and ask (in quote currency) of a pair."""
+        base, quote = self.pairs[trading_pair]
+        i, j = self.index[base], self.index[quote]
+        with self.lock:
+            self.rates[i][j] = float(bid)
+            self.rates[j][i] = 1 / float(ask) if ask else 0.0
+            rates = self.rates
+            for a, b, c in self.cycles[trading_pair]:
+                self.spreads[(a, b, c)] = rates[a][b] * rates[b][c] * rates[c][a] - 1
+
+    def update_orderbook_compact(self, trading_pair, result):
+        """Update a pair from a showOrderbookCompact result."""
+        orders = result.get('orders', {})
+        bids = orders.get('bids') or []
+        asks = orders.get('asks') or []
+        if bids and asks:
+            self.update(trading_pair, max(b['price'] for b in bids),
+                        min(a['price'] for a in asks))
+
+    def update_rates(self, trading_pair, result):
+        """Update a pair from a showRates result, using the weighted rate."""
+        rate = result.get('rates', {}).get('rate_weighted')
+        if rate is not None:
+            self.update(trading_pair, rate, rate)
+
+    def snapshot_state(self):
+        with self.lock:
+            return {'currencies': self.currencies,
+                    'rates': [list(row) for row in self.rates],
+                    'spreads': dict(self.spreads)}
+
+    def restore_state(self, state):
+        if state['currencies'] == self.currencies:
+            cycles = set().union(*self.cycles.values())
+            with self.lock:
+                self.rates = state['rates']
+                self.spreads = {cycle: spread for cycle, spread
+                                in state['spreads'].items() if cycle in cycles}
+
+    def rate(self, source, target):
+        return self.rates[self.index[source]][self.index[target]]
+
+    def implied_rate(self, source, target):
+        """Best rate from source to target, direct or via one other currency."""
+        i, j = self.index[source], self.index[target]
+        rates = self.rates
+        return max(rates[i][k] * rates[k][j] for k in range(len(rates)))
+
+    def opportunities(self, min_spread=0.0):
+        """Cycles with a spread above min_spread, best first."""
+        with self.lock:
+            spreads = list(self.spreads.items())
+        found = [(spread, tuple(self.currencies[i] for i in cycle))
+                 for cycle, spread in spreads if spread > min_spread]
+        return sorted(found, reverse=True)
+
+
+class CandleSeries(object):
+    """Ring buffer of OHLCV bars of one resolution (in seconds)."""
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.latest = None
+        self.starts = [None] * size
+        self.opens = [None] * size
+        self.highs = [None] * size
+        self.lows = [None] * size
+        self.closes = [None] * size
+        self.volumes = [None] * size
+        self.counts = [0] * size
+        # tids of the opening and closing trade to place late trades
+        self.open_tids = [None] * size
+        self.close_tids = [None] * size
+
+    def add(self, timestamp, price, amount, tid):
+        """Add a trade, False if it is older than the buffer."""
+        start = int(timestamp) // self.resolution * self.resolution
+        if self.latest is not None and start <= self.latest - self.size * self.resolution:
+            return False
+        slot = start // self.resolution % self.size
+        if self.starts[slot] != start:
+            self.starts[slot] = start
+            self.opens[slot] = self.highs[slot] = self.lows[slot] = price
+            self.closes[slot] = price
+            self.volumes[slot] = amount
+            self.counts[slot] = 1
+            self.open_tids[slot] = self.close_tids[slot] = tid
+        else:
+            if price > self.highs[slot]:
+                self.highs[slot] = price
+            if price < self.lows[slot]:
+                self.lows[slot] = price
+            if tid < self.open_tids[slot]:
+                self.opens[slot], self.open_tids[slot] = price, tid
+            if tid > self.close_tids[slot]:
+                self.closes[slot], self.close_tids[slot] = price, tid
+            self.volumes[slot] += amount
+            self.counts[slot] += 1
+        if self.latest is None or start > self.latest:
+            self.latest = start
+        return True
+
+    def bars(self):
+        """Bars in the buffer, oldest first."""
+        if self.latest is None:
+            return []
+        oldest = self.latest - (self.size - 1) * self.resolution
+        result = []
+        for start in range(oldest, self.latest + 1, self.resolution):
+            slot = start // self.resolution % self.size
+            if self.starts[slot] == start:
+                result.append({'start': start, 'open': self.opens[slot],
+                               'high': self.highs[slot], 'low': self.lows[slot],
+                               'close': self.closes[slot],
+                               'volume': self.volumes[slot],
+                               'trades': self.counts[slot]})
+        return result
+
+
+class CandleBuilder(object):
+    """Build OHLCV candles incrementally from showPublicTradeHistory trades.
+
+    Trades are deduplicated by tid (the last tid_memory tids per pair are
+    remembered), late trades update the bar they belong to as long as it
+    is still buffered. Memory is bounded by size bars per resolution."""
+    def __init__(self, resolutions=(1, 60, 3600), size=1440, tid_memory=100000):
+        self.resolutions = resolutions
+        self.size = size
+        self.tid_memory = tid_memory
+        self.series = {}
+        self.seen = {}
+        self.last_tids = {}
+        self.lock = threading.Lock()
+
+    def add_trades(self, trading_pair, trades):
+        """Add trades, return the number of new ones."""
+        with self.lock:
+            return self.add_trades_locked(trading_pair, trades)
+
+    def add_trades_locked(self, trading_pair, trades):
+        if trading_pair not in self.series:
+            self.series[trading_pair] = {r: CandleSeries(r, self.size)
+                                         for r in self.resolutions}
+            self.seen[trading_pair] = (set(), collections.deque())
+        series = self.series[trading_pair].values()
+        seen, order = self.seen[trading_pair]
+        added = 0
+        for trade in trades:
+            tid = trade['tid']
+            if tid in seen:
+                continue
+            seen.add(tid)
+            order.append(tid)
+            if len(order) > self.tid_memory:
+                seen.discard(order.popleft())
+            price = decimal.Decimal(str(trade['price']))
+            amount = decimal.Decimal(str(trade['amount']))
+            for candles in series:
+                candles.add(trade['date'], price, amount, tid)
+            if tid > self.last_tids.get(trading_pair, tid - 1):
+                self.last_tids[trading_pair] = tid
+            added += 1
+        return added
+
+    def snapshot_state(self):
+        with self.lock:
+            return copy.deepcopy({'series': self.series, 'seen': self.seen,
+                                  'last_tids': self.last_tids})
+
+    def restore_state(self, state):
+        with self.lock:
+            self.series = state['series']
+            self.seen = state['seen']
+            self.last_tids = state['last_tids']
+
+    def last_tid(self, trading_pair):
+        """Highest tid seen, to be passed as since_tid on the next poll."""
+        return self.last_tids.get(trading_pair)
+
+    def candles(self, trading_pair, resolution):
+        """Bars of a pair and resolution, oldest first."""
+        with self.lock:
+            if trading_pair not in self.series:
+                return []
+            return self.series[trading_pair][resolution].bars()
+
+
+BUS_MAGIC = b'BTCDEBUS'
+BUS_HEADER = struct.Struct('<8sIIII')
+BUS_KEY_SIZE = 64
+BUS_SLOT_HEADER = struct.Struct('<QI4x')
+BUS_HEAD = struct.Struct('<Q')
+
+
+class MarketDataPublisher(object):
+    """Publish raw market data responses into a memory-mapped file.
+
+    Attach it as recorder of the polling Connection. Every key (trading
+    pair and endpoint path, e.g. 'btceur/rates') owns a ring of depth
+    slots. Each slot is guarded by a seqlock style sequence number which is
+    odd while the slot is written, so readers in other processes never
+    see a torn snapshot."""
+    def __init__(self, path, trading_pairs, endpoints=('orderbook/compact', 'rates'),
+                 slot_size=65536, depth=4):
+        self.keys = [f'{pair}/{endpoint}' for pair in trading_pairs
+                     for endpoint in endpoints]
+        self.slot_size = slot_size
+        self.depth = depth
+        self.offsets = {}
+        offset = BUS_HEADER.size + len(self.keys) * BUS_KEY_SIZE
+        region = BUS_HEAD.size + depth * (BUS_SLOT_HEADER.size + slot_size)
+        for key in self.keys:
+            self.offsets[key] = offset
+            offset += region
+        with open(path, 'wb') as f:
+            f.truncate(offset)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), offset)
+        BUS_HEADER.pack_into(self.map, 0, BUS_MAGIC, 1, len(self.keys),
+                             slot_size, depth)
+        for i, key in enumerate(self.keys):
+            position = BUS_HEADER.size + i * BUS_KEY_SIZE
+            self.map[position:position + BUS_KEY_SIZE] = key.encode().ljust(BUS_KEY_SIZE, b'\0')
+        self.heads = dict.fromkeys(self.keys, 0)
+
+    def publish(self, key, body):
+        """Write body as newest snapshot of key."""
+        if len(body) > self.slot_size:
+            log.warning('Snapshot of {} exceeds slot size'.format(key))
+            return False
+        head = self.heads[key] + 1
+        position = (self.offsets[key] + BUS_HEAD.size
+                    + head % self.depth * (BUS_SLOT_HEADER.size + self.slot_size))
+        sequence, _ = BUS_SLOT_HEADER.unpack_from(self.map, position)
+        BUS_SLOT_HEADER.pack_into(self.map, position, sequence + 1, len(body))
+        data = position + BUS_SLOT_HEADER.size
+        self.map[data:data + len(body)] = body
+        BUS_SLOT_HEADER.pack_into(self.map, position, sequence + 2, len(body))
+        BUS_HEAD.pack_into(self.map, self.offsets[key], head)
+        self.heads[key] = head
+        return True
+
+    def record(self, method, url, r):
+        key = url.split('?')[0].split('/v4/', 1)[-1]
+        if method == 'GET' and r.status_code == 200 and key in self.offsets:
+            self.publish(key, r.content)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class MarketDataBusReader(object):
+    """Read the latest snapshots of a MarketDataPublisher.
+
+    showOrderbookCompact and showRates answer like a Connection, decoding
+    each published snapshot only once."""
+    def __init__(self, path, retries=100):
+        self.retries = retries
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, count, self.slot_size, self.depth = BUS_HEADER.unpack_from(self.map, 0)
+        if magic != BUS_MAGIC:
+            raise ValueError("{} is not a market data bus".format(path))
+        region = BUS_HEAD.size + self.depth * (BUS_SLOT_HEADER.size + self.slot_size)
+        offset = BUS_HEADER.size + count * BUS_KEY_SIZE
+        self.offsets = {}
+        for i in range(count):
+            position = BUS_HEADER.size + i * BUS_KEY_SIZE
+            key = bytes(self.map[position:position + BUS_KEY_SIZE]).rstrip(b'\0').decode()
+            self.offsets[key] = offset + i * region
+        self.decoded = {}
+
+    def read(self, key):
+        """Return (version, body) of the newest snapshot, version 0 if none."""
+        offset = self.offsets[key]
+        for _ in range(self.retries):
+            head, = BUS_HEAD.unpack_from(self.map, offset)
+            if head == 0:
+                return 0, b''
+            position = (offset + BUS_HEAD.size
+                        + head % self.depth * (BUS_SLOT_HEADER.size + self.slot_size))
+            sequence, length = BUS_SLOT_HEADER.unpack_from(self.map, position)
+            if sequence % 2:
+                continue
+            data = position + BUS_SLOT_HEADER.size
+            body = self.map[data:data + length]
+            if BUS_SLOT_HEADER.unpack_from(self.map, position)[0] == sequence:
+                return head, body
+        raise RuntimeError("no consistent snapshot of {}".format(key))
+
+    def latest(self, key):
+        version, body = self.read(key)
+        if not version:
+            return {}
+        cached = self.decoded.get(key)
+        if cached is not None and cached[0] == version:
+            result = PolledResult(cached[1])
+            result.unchanged = True
+            return result
+        result = PolledResult(json.loads(body, parse_float=decimal.Decimal))
+        self.decoded[key] = (version, result)
+        return result
+
+    def showOrderbookCompact(self, trading_pair):
+        """Bids and Asks in compact format."""
+        return self.latest(f'{trading_pair}/orderbook/compact')
+
+    def showRates(self, trading_pair):
+        """Query of the average rate last 3 and 12 hours."""
+        return self.latest(f'{trading_pair}/rates')
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def orderbook_levels(result):
+    """Map a showOrderbookCompact result to {'bids': {price: amount}, 'asks': ...}."""
+    orders = result.get('orders') or {}
+    return {side: {decimal.Decimal(str(level['price'])): decimal.Decimal(str(level['amount']))
+                   for level in orders.get(side) or []}
+            for side in ('bids', 'asks')}
+
+
+def diff_levels(old, new):
+    """List (side, price, amount) changes from old to new levels, amount 0 removes."""
+    delta = []
+    for side in ('bids', 'asks'):
+        before, after = old.get(side, {}), new.get(side, {})
+        for price, amount in after.items():
+            if before.get(price) != amount:
+                delta.append((side, price, amount))
+        for price in before.keys() - after.keys():
+            delta.append((side, price, decimal.Decimal(0)))
+    return delta
+
+
+def apply_levels(levels, delta):
+    """Apply (side, price, amount) changes in place."""
+    for side, price, amount in delta:
+        if amount:
+            levels[side][price] = amount
+        else:
+            levels[side].pop(price, None)
+    return levels
+
+
+def levels_to_orderbook(levels):
+    """Build the 'orders' part of a showOrderbookCompact result from levels."""
+    return {'bids': [{'price': p, 'amount': a}
+                     for p, a in sorted(levels['bids'].items(), reverse=True)],
+            'asks': [{'price': p, 'amount': a}
+                     for p, a in sorted(levels['asks'].items())]}
+
+
+FRAME_SNAPSHOT = 1
+FRAME_DELTA = 2
+FRAME_HEADER = struct.Struct('<IBB')
+FRAME_COUNT = struct.Struct('<I')
+# side, price and amount as integer coefficient and decimal exponent
+FRAME_LEVEL = struct.Struct('<Bqbqb')
+SIDES = ('bids', 'asks')
+
+
+def split_decimal(value):
+    sign, digits, exponent = value.as_tuple()
+    coefficient = int(''.join(map(str, digits)) or 0)
+    return -coefficient if sign else coefficient, exponent
+
+
+def encode_frame(kind, trading_pair, delta):
+    """Encode level changes of a pair as length prefixed binary frame."""
+    pair = trading_pair.encode()
+    body = [pair, FRAME_COUNT.pack(len(delta))]
+    for side, price, amount in delta:
+        body.append(FRAME_LEVEL.pack(SIDES.index(side), *split_decimal(price),
+                                     *split_decimal(amount)))
+    body = b''.join(body)
+    return FRAME_HEADER.pack(len(body), kind, len(pair)) + body
+
+
+def decode_frame(kind, pair_length, body):
+    """Decode a frame body to (kind, trading_pair, delta)."""
+    trading_pair = body[:pair_length].decode()
+    count, = FRAME_COUNT.unpack_from(body, pair_length)
+    delta = []
+    offset = pair_length + FRAME_COUNT.size
+    for _ in range(count):
+        side, price, price_exp, amount, amount_exp = FRAME_LEVEL.unpack_from(body, offset)
+        delta.append((SIDES[side], decimal.Decimal(price).scaleb(price_exp),
+                      decimal.Decimal(amount).scaleb(amount_exp)))
+        offset += FRAME_LEVEL.size
+    return kind, trading_pair, delta
+
+
+class OrderbookDeltaServer(object):
+    """Poll compact order books once and fan out level deltas over a Unix socket.
+
+    A new subscriber first receives a snapshot frame per trading pair and
+    then delta frames with the changed levels of every poll. Subscribers
+    which can not keep up within send_timeout seconds are dropped."""
+    def __init__(self, conn, socket_path, trading_pairs, interval=1, send_timeout=1):
+        self.conn = conn
+        self.socket_path = socket_path
+        self.trading_pairs = trading_pairs
+        self.interval = interval
+        self.send_timeout = send_timeout
+        self.books = {pair: {'bids': {}, 'asks': {}} for pair in trading_pairs}
+        self.clients = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.stopped = threading.Event()
+        self.threads = []
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen()
+
+    def broadcast(self, frame, clients):
+        for client in list(clients):
+            try:
+                client.sendall(frame)
+            except OSError:
+                clients.remove(client)
+                client.close()
+
+    def accept(self):
+        """Accept one subscriber and send it the current snapshots."""
+        client, _ = self.server.accept()
+        client.settimeout(self.send_timeout)
+        with self.lock:
+            frames = [encode_frame(FRAME_SNAPSHOT, pair,
+                                   diff_levels({}, self.books[pair]))
+                      for pair in self.trading_pairs]
+            try:
+                client.sendall(b''.join(frames))
+            except OSError:
+                client.close()
+                return
+            self.clients.append(client)
+
+    def poll_once(self):
+        """Poll every pair once and send deltas of changed books."""
+        for pair in self.trading_pairs:
+            try:
+                result = self.conn.showOrderbookCompact(pair)
+                if not result:
+                    continue
+                levels = orderbook_levels(result)
+                with self.lock:
+                    delta = diff_levels(self.books[pair], levels)
+                    if delta:
+                        frame = encode_frame(FRAME_DELTA, pair, delta)
+                        self.books[pair] = levels
+                        self.broadcast(frame, self.clients)
+            except Exception as e:
+                log.warning('Polling orderbook {} failed: {}'.format(pair, e))
+
+    def run_accept(self):
+        while self.running:
+            try:
+                self.accept()
+            except OSError:
+                break
+
+    def run_poll(self):
+        while self.running:
+            start = time.monotonic()
+            self.poll_once()
+            self.stopped.wait(max(0, self.interval - (time.monotonic() - start)))
+
+    def start(self):
+        self.running = True
+        self.stopped.clear()
+        for target in (self.run_accept, self.run_poll):
+            thread = threading.Thread(target=target, daemon=True,
+                                      name='btcde-fanout')
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        try:
+            # wakes up the accepting thread
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class OrderbookDeltaClient(object):
+    """Subscribe to an OrderbookDeltaServer and keep the books locally."""
+    def __init__(self, socket_path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.books = {}
+
+    def read_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise EOFError('fan-out server closed the connection')
+            data.extend(chunk)
+        return bytes(data)
+
+    def receive(self):
+        """Receive and apply one frame, return (kind, trading_pair, delta)."""
+        length, kind, pair_length = FRAME_HEADER.unpack(self.read_exactly(FRAME_HEADER.size))
+        kind, trading_pair, delta = decode_frame(kind, pair_length,
+                                                 self.read_exactly(length))
+        if kind == FRAME_SNAPSHOT:
+            self.books[trading_pair] = {'bids': {}, 'asks': {}}
+        apply_levels(self.books[trading_pair], delta)
+        return kind, trading_pair, delta
+
+    def showOrderbookCompact(self, trading_pair):
+        """Bids and Asks in compact format, from the local book."""
+        if trading_pair not in self.books:
+            return {}
+        return {'orders': levels_to_orderbook(self.books[trading_pair]), 'errors': []}
+
+    def close(self):
+        self.socket.close()
+
+
+class LedgerEngine(object):
+    """Running balances, fees and realized PnL from showAccountLedger entries.
+
+    Entries are consumed incrementally, the state per currency is written
+    to a JSON checkpoint file at most every checkpoint_interval seconds. After
+    a restart sync() only requests entries since the last consumed date.
+    Realized PnL uses the average cost of the traded amounts in the quote
+    currency of the trade price; entries without a trade only change the
+    balance."""
+    FIELDS = ('balance', 'fees', 'realized', 'position', 'cost')
+
+    def __init__(self, checkpoint_path=None, checkpoint_interval=60):
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = 0
+        self.state = {}
+        self.lock = threading.RLock()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                for currency, data in json.load(f).items():
+                    state = self.get(currency)
+                    for field in self.FIELDS:
+                        state[field] = decimal.Decimal(data[field])
+                    state['last_date'] = data['last_date']
+                    state['boundary'] = set(data['boundary'])
+
+    def snapshot_state(self):
+        with self.lock:
+            return copy.deepcopy(self.state)
+
+    def restore_state(self, state):
+        with self.lock:
+            self.state = state
+
+    def get(self, currency):
+        """State of a currency: balance, fees, realized, position, cost and last_date."""
+        with self.lock:
+            if currency not in self.state:
+                state = dict.fromkeys(self.FIELDS, decimal.Decimal(0))
+                state.update(last_date=None, boundary=set())
+                self.state[currency] = state
+            return self.state[currency]
+
+    def consume(self, currency, entries):
+        """Apply new ledger entries of currency (any order), return how many were new."""
+        with self.lock:
+            return self.consume_locked(currency, entries)
+
+    def consume_locked(self, currency, entries):
+        state = self.get(currency)
+        last = parse_datetime(state['last_date']) if state['last_date'] else None
+        dated = sorted(((parse_datetime(e['date']), e) for e in entries),
+                       key=lambda item: item[0])
+        applied = 0
+        for timestamp, entry in dated:
+            key = '{}|{}|{}'.format(entry['date'], entry['type'], entry['reference'])
+            if last is not None and (timestamp < last or
+                                     (timestamp == last and key in state['boundary'])):
+                continue
+            if last is None or timestamp > last:
+                last = timestamp
+                state['last_date'] = entry['date']
+                state['boundary'] = set()
+            state['boundary'].add(key)
+            self.apply(currency, state, entry)
+            applied += 1
+        return applied
+
+    def apply(self, currency, state, entry):
+        cashflow = decimal.Decimal(entry['cashflow'])
+        if entry.get('balance') is not None:
+            state['balance'] = decimal.Decimal(entry['balance'])
+        else:
+            state['balance'] += cashflow
+        trade = entry.get('trade')
+        if not trade or currency not in trade:
+            return
+        price = decimal.Decimal(trade['price'])
+        before = decimal.Decimal(trade[currency]['before_fee'])
+        after = decimal.Decimal(trade[currency]['after_fee'])
+        state['fees'] += before - after
+        if cashflow > 0:
+            state['position'] += after
+            state['cost'] += before * price
+        elif state['position'] > 0:
+            amount = min(before, state['position'])
+            average = state['cost'] / state['position']
+            state['realized'] += amount * (price - average)
+            state['position'] -= amount
+            state['cost'] -= amount * average
+
+    def checkpoint(self):
+        """Write the state atomically to checkpoint_path."""
+        with self.lock:
+            data = {currency: dict({field: str(state[field]) for field in self.FIELDS},
+                                   last_date=state['last_date'],
+                                   boundary=sorted(state['boundary']))
+                    for currency, state in self.state.items()}
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, self.checkpoint_path)
+        self.last_checkpoint = time.monotonic()
+
+    def sync(self, conn, currency):
+        """Fetch and apply entries since the last consumed date, all pages.
+
+        Nothing is applied if a page cannot be fetched."""
+        args = {}
+        last_date = self.get(currency)['last_date']
+        if last_date:
+            args['datetime_start'] = last_date
+        # pages are newest first, so the window is applied as a whole
+        entries = []
+        page, last = 1, 1
+        while page <= last:
+            result = conn.showAccountLedger(currency, page=page, **args)
+            if not result:
+                return 0
+            entries.extend(result.get('account_ledger', []))
+            last = result.get('page', {}).get('last', 1)
+            page += 1
+        applied = self.consume(currency, entries)
+        if (self.checkpoint_path and time.monotonic() - self.last_checkpoint
+                >= self.checkpoint_interval):
+            self.checkpoint()
+        return applied
+
+
+class AddressPoolManager(object):
+    """Bulk synchronisation of the address pool of a currency.
+
+    A local index of the pool is built from listAddressPool. As new
+    addresses are appended to the end of the list, refresh() only reads
+    again from the last known page on. sync() uploads and optionally
+    removes only the difference, in parallel batches which pause while the
+    connection's credits are below its min_credits."""
+    def __init__(self, conn, currency, credit_wait=5):
+        ParameterBuilder({}, {}, '').verify_keys_and_values(
+            ['currency'], {'currency': currency})
+        self.conn = conn
+        self.currency = currency
+        self.credit_wait = credit_wait
+        self.index = {}
+        self.pages = {}
+        self.last_page = 1
+        self.lock = threading.Lock()
+
+    def snapshot_state(self):
+        with self.lock:
+            return copy.deepcopy({'index': self.index, 'pages': self.pages,
+                                  'last_page': self.last_page})
+
+    def restore_state(self, state):
+        with self.lock:
+            self.index = state['index']
+            self.pages = state['pages']
+            self.last_page = state['last_page']
+
+    def refresh(self, full=False):
+        """Update the local index, return False if a page could not be read."""
+        if full:
+            with self.lock:
+                self.index, self.pages, self.last_page = {}, {}, 1
+        page = self.last_page
+        last = page
+        while page <= last:
+            result = self.conn.listAddressPool(self.currency, page=page)
+            if not result:
+                return False
+            entries = result.get('addresses', [])
+            with self.lock:
+                for address in self.pages.get(page, []):
+                    self.index.pop(address, None)
+                self.pages[page] = [entry['address'] for entry in entries]
+                self.index.update((entry['address'], entry) for entry in entries)
+                self.last_page = page
+            last = result.get('page', {}).get('last', page)
+            page += 1
+        return True
+
+    def run(self, calls, progress=None):
+        report = {}
+        batch_size = self.conn.pool_size
+        for start in range(0, len(calls), batch_size):
+            while not self.conn.has_credits(2):
+                time.sleep(self.credit_wait)
+                # a cheap call to learn the current credits
+                self.conn.showPermissions()
+            batch = [(address, self.conn.submit_write(func, *args, **kwargs))
+                     for address, func, args, kwargs in calls[start:start + batch_size]]
+            for address, future in batch:
+                try:
+                    report[address] = future.result()
+                except Exception as e:
+                    HandleRequestsException(e)
+                    report[address] = {}
+            if progress is not None:
+                progress(len(report), len(calls))
+        return report
+
+    def sync(self, addresses, remove_missing=False, progress=None, **args):
+        """Make the pool contain addresses, args as for addToAddressPool.
+
+        Returns a dict of address to the result of its add or remove call,
+        an empty result marks a failure. progress(done, total) is called
+        after every batch."""
+        wanted = set(addresses)
+        with self.lock:
+            known = set(self.index)
+        calls = [(address, self.conn.addToAddressPool, (self.currency, address), args)
+                 for address in sorted(wanted - known)]
+        if remove_missing:
+            calls += [(address, self.conn.removeFromAddressPool,
+                       (self.currency, address), {})
+                      for address in sorted(known - wanted)]
+        report = self.run(calls, progress)
+        for address, func, _, _ in calls:
+            if not report[address]:
+                continue
+            with self.lock:
+                if func == self.conn.addToAddressPool:
+                    self.index[address] = {'address': address}
+                else:
+                    self.index.pop(address, None)
+        return report
+
+
+class SettlementQueue(object):
+    """Durable queue of trade settlement actions, executed by worker threads.
+
+    Actions are stored in a SQLite database and deduplicated per trade_id
+    and action. Actions which were running when the process died are
+    pending again after a restart. Failed calls (empty results) are retried
+    after retry_delay seconds up to max_attempts times. With a planner,
+    candidates are collected every collect_interval seconds while started.
+    There is no default planner: marking a trade as paid or coins as
+    transferred must follow an actual payment or transfer."""
+    ACTIONS = ['markTradeAsPaid', 'markCoinsAsTransferred', 'markCoinsAsReceived',
+               'markTradeAsPaymentReceived', 'addTradeRating']
+
+    def __init__(self, conn, path, workers=4, max_attempts=5, retry_delay=30,
+                 planner=None, collect_interval=60):
+        self.conn = conn
+        self.path = path
+        self.workers = workers
+        self.planner = planner
+        self.collect_interval = collect_interval
+        self.stopped = threading.Event()
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.running = False
+        self.threads = []
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS actions ('
+                        'trade_id TEXT, action TEXT, trading_pair TEXT, '
+                        'params TEXT, state TEXT, attempts INTEGER, '
+                        'not_before REAL, result TEXT, '
+                        'PRIMARY KEY (trade_id, action))')
+        self.db.execute("UPDATE actions SET state = 'pending' WHERE state = 'running'")
+
+    def add(self, action, trading_pair, trade_id, **params):
+        """Queue an action, return False if it is already known for trade_id."""
+        if action not in self.ACTIONS:
+            raise ValueError("{} is not any of {}".format(action, ', '.join(self.ACTIONS)))
+        ParameterBuilder({}, {}, '').verify_keys_and_values(
+            ['trading_pair'], {'trading_pair': trading_pair})
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO actions VALUES (?, ?, ?, ?, 'pending', 0, 0, NULL)",
+                (trade_id, action, trading_pair, json.dumps(params, default=str)))
+        return cursor.rowcount == 1
+
+    def collect(self, planner=None):
+        """Queue actions for trades which need a payment or transfer action.
+
+        planner(trade) returns a list of (action, params) for a trade of
+        showMyTrades(only_trades_with_action_for_payment_or_transfer_required=1),
+        self.planner if not given. Returns the number of newly queued actions."""
+        planner = planner or self.planner
+        if planner is None:
+            raise ValueError('collect() needs a planner')
+        added = 0
+        page, last = 1, 1
+        while page <= last:
+            result = self.conn.showMyTrades(
+                only_trades_with_action_for_payment_or_transfer_required=1, page=page)
+            if not result:
+                break
+            for trade in result.get('trades', []):
+                for action, params in planner(trade) or []:
+                    added += self.add(action, trade['trading_pair'],
+                                      trade['trade_id'], **params)
+            last = result.get('page', {}).get('last', 1)
+            page += 1
+        return added
+
+    def claim(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT trade_id, action, trading_pair, params, attempts FROM actions "
+                "WHERE state = 'pending' AND not_before <= ? LIMIT 1",
+                (time.time(),)).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE actions SET state = 'running' "
+                                "WHERE trade_id = ? AND action = ?", row[:2])
+        return row
+
+    def finish(self, trade_id, action, attempts, result):
+        if result:
+            state, not_before = 'done', 0
+        elif attempts >= self.max_attempts:
+            state, not_before = 'failed', 0
+        else:
+            state, not_before = 'pending', time.time() + self.retry_delay
+        with self.lock:
+            self.db.execute("UPDATE actions SET state = ?, attempts = ?, not_before = ?, "
+                            "result = ? WHERE trade_id = ? AND action = ?",
+                            (state, attempts, not_before, json.dumps(result, default=str),
+                             trade_id, action))
+
+    def run_one(self):
+        """Execute one due action, return False if there was none."""
+        row = self.claim()
+        if row is None:
+            return False
+        trade_id, action, trading_pair, params, attempts = row
+        try:
+            result = getattr(self.conn, action)(trading_pair, trade_id, **json.loads(params))
+        except Exception as e:
+            HandleRequestsException(e)
+            result = {}
+        self.finish(trade_id, action, attempts + 1, result)
+        return True
+
+    def work(self):
+        while self.running:
+            if not self.run_one():
+                time.sleep(1)
+
+    def poll(self):
+        while not self.stopped.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                log.warning('Collecting settlement actions failed: %s', e)
+            self.stopped.wait(self.collect_interval)
+
+    def start(self):
+        self.running = True
+        self.stopped.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True,
+                                      name=f'btcde-settlement-{i}')
+            thread.start()
+            self.threads.append(thread)
+        if self.planner is not None and self.collect_interval:
+            thread = threading.Thread(target=self.poll, daemon=True,
+                                      name='btcde-settlement-collect')
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def states(self):
+        """Count of actions per state."""
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT state, COUNT(*) FROM actions GROUP BY state').fetchall())
+
+
+class WriteJournal(object):
+    """Append-only write-ahead journal of trading actions.
+
+    Every POST and DELETE of a Connection with this journal is logged with
+    its signed nonce before it is sent, and its outcome after the answer.
+    Intents are fsynced before sending; concurrent writers share one fsync
+    (group commit). Outcomes are only flushed, a lost outcome merely makes
+    the entry in doubt. After a crash recover() looks up only the entries
+    without outcome."""
+    def __init__(self, path, sync_interval=1):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        self.last_sync = time.monotonic()
+        self.file = open(path, 'ab')
+        if self.file.tell():
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # terminate a line torn by a crash
+                    self.file.write(b'\n')
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, default=str).encode() + b'\n')
+            self.written += 1
+            return self.written
+
+    def sync(self, position):
+        """Make sure everything up to position is on disk."""
+        with self.sync_lock:
+            if self.synced >= position:
+                # another writer's fsync covered this record
+                return
+            with self.lock:
+                self.file.flush()
+                position = self.written
+            os.fsync(self.file.fileno())
+            self.synced = position
+            self.last_sync = time.monotonic()
+
+    def intent(self, method, url, nonce, encoded_string):
+        """Durably log a request before it is sent, return its entry id."""
+        self.sync(self.append({'id': nonce, 'time': time.time(), 'method': method,
+                               'url': url, 'data': encoded_string}))
+        return nonce
+
+    def outcome(self, entry, status, body):
+        position = self.append({'id': entry, 'status': status,
+                                'body': body.decode('utf-8', 'replace')})
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync(position)
+
+    def resolve(self, entry, resolution):
+        self.sync(self.append({'id': entry, 'resolved': resolution}))
+
+    def entries(self):
+        """Read all intents with their outcome or resolution merged in."""
+        with self.lock:
+            self.file.flush()
+        return self.read_entries()
+
+    def read_entries(self):
+        entries = {}
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn last line of a crash
+                    continue
+                entries.setdefault(record['id'], {}).update(record)
+        return [e for e in entries.values() if 'method' in e]
+
+    def in_doubt(self):
+        """Intents which have neither an outcome nor a resolution."""
+        return [e for e in self.entries()
+                if 'status' not in e and 'resolved' not in e]
+
+    def lookup(self, conn, entry):
+        path = entry['url'].split('?')[0].split('/v4/', 1)[-1].split('/')
+        trading_pair = path[0]
+        if entry['method'] == 'DELETE' and path[1:2] == ['orders']:
+            return conn.showMyOrderDetails(trading_pair, path[2])
+        if entry['method'] == 'POST' and path[1:] == ['orders']:
+            # the order id is unknown, ask for own orders around that time
+            return conn.showMyOrders(trading_pair=trading_pair,
+                                     date_start=format_datetime(entry['time'] - 60),
+                                     date_end=format_datetime(entry['time'] + 60))
+        if entry['method'] == 'POST' and path[1:2] == ['trades'] and len(path) == 3:
+            # executeTrade names the offer's order id, the trade id is
+            # unknown: ask for own trades around that time
+            return conn.showMyTrades(trading_pair=trading_pair,
+                                     date_start=format_datetime(entry['time'] - 60),
+                                     date_end=format_datetime(entry['time'] + 60))
+        if entry['method'] == 'POST' and path[1:2] == ['trades'] and len(path) == 4:
+            # settlement actions, .../trades/{trade_id}/mark_...
+            return conn.showMyTradeDetails(trading_pair, path[2])
+        return None
+
+    def recover(self, conn):
+        """Look up every in-doubt entry once, return (entry, result) pairs.
+
+        The lookup result (showMyOrderDetails, showMyOrders or showMyTrades
+        of the minutes around a createOrder or executeTrade, or
+        showMyTradeDetails) is stored as resolution
+        of the entry; entries which can not be looked up stay in doubt."""
+        recovered = []
+        for entry in self.in_doubt():
+            result = self.lookup(conn, entry)
+            if result:
+                self.resolve(entry['id'], result)
+            recovered.append((entry, result))
+        return recovered
+
+    def compact(self):
+        """Rewrite the journal keeping only entries still in doubt.
+
+        Appends wait until the new file is in place, so no record written
+        meanwhile is lost."""
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            keep = [e for e in self.read_entries()
+                    if 'status' not in e and 'resolved' not in e]
+            temporary = self.path + '.tmp'
+            with open(temporary, 'wb') as f:
+                for entry in keep:
+                    f.write(json.dumps(entry, default=str).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(temporary, self.path)
+            self.file = open(self.path, 'ab')
+            self.synced = self.written
+
+    def close(self):
+        self.sync(self.written)
+        self.file.close()
+
+
+SNAPSHOT_MAGIC = b'BTCDESNAP1'
+
+
+class StateSnapshot(object):
+    """Save btcde managed state to a binary file and load it at start.
+
+    Components (Connection, OrderTracker, LedgerEngine, CandleBuilder,
+    RateGraph, AddressPoolManager or anything with snapshot_state and
+    restore_state) are registered by name and restored right away if the
+    snapshot has them. An optional validate callable is run in a background
+    thread after restoring, e.g. OrderTracker.reconcile. Plain API results
+    are kept with cached(). The file is a pickle and must only be loaded
+    from trusted locations."""
+    def __init__(self, path):
+        self.path = path
+        self.components = {}
+        self.values = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        if os.path.exists(path) and os.path.getsize(path) > len(SNAPSHOT_MAGIC):
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if data[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC:
+                        with memoryview(data) as view:
+                            with view[len(SNAPSHOT_MAGIC):] as payload:
+                                self.loaded = pickle.loads(payload)
+        self.values = dict(self.loaded.get('values', {}))
+        # values from the snapshot not yet revalidated
+        self.stale = set(self.values)
+
+    def validate_later(self, validate):
+        thread = threading.Thread(target=validate, daemon=True,
+                                  name='btcde-snapshot-validate')
+        thread.start()
+        return thread
+
+    def register(self, name, component, validate=None):
+        """Add a component, restoring its state from the snapshot."""
+        self.components[name] = component
+        state = self.loaded.get('components', {}).get(name)
+        if state is not None:
+            component.restore_state(state)
+            if validate is not None:
+                self.validate_later(validate)
+        return component
+
+    def cached(self, name, loader):
+        """Value of loader() from the snapshot, refreshed once in the background.
+
+        Without a snapshot value loader is called right away, e.g.
+        snapshot.cached('permissions', conn.showPermissions)."""
+        with self.lock:
+            if name in self.values:
+                if name in self.stale:
+                    self.stale.discard(name)
+                    self.validate_later(lambda: self.refresh(name, loader))
+                return self.values[name]
+        return self.refresh(name, loader)
+
+    def refresh(self, name, loader):
+        value = loader()
+        if value:
+            with self.lock:
+                self.values[name] = value
+        return value
+
+    def save(self):
+        """Write all registered states and cached values atomically."""
+        with self.lock:
+            data = {'components': {name: component.snapshot_state()
+                                   for name, component in self.components.items()},
+                    'values': dict(self.values)}
+            payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def run(self, interval):
+        while self.running:
+            time.sleep(interval)
+            if self.running:
+                try:
+                    self.save()
+                except Exception as e:
+                    log.warning('Saving snapshot {} failed: {}'.format(self.path, e))
+
+    def start(self, interval=60):
+        """Save every interval seconds and at interpreter exit."""
+        self.running = True
+        atexit.register(self.close)
+        self.thread = threading.Thread(target=self.run, args=(interval,),
+                                       daemon=True, name='btcde-snapshot')
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.save()
+
+
+class ConnectionManager(object):
+    """Many accounts on one transport pool with fair request scheduling.
+
+    Every account is a Connection with its own nonce sequence and credit
+    budget (min_credits), but all share one requests.Session with at most
+    pool_size sockets. Calls submitted with submit() are queued per account
+    and picked round-robin by a fixed number of workers. Accounts whose
+    last reported credits are below their budget are skipped until
+    credit_wait seconds have passed since their last call."""
+    def __init__(self, pool_size=20, workers=8, credit_wait=5):
+        self.pool_size = pool_size
+        self.workers = workers
+        self.credit_wait = credit_wait
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.accounts = collections.OrderedDict()
+        self.queues = {}
+        self.last_call = {}
+        self.cursor = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+
+    def add_account(self, name, api_key, api_secret, **args):
+        """Add an account, args as for Connection (e.g. min_credits)."""
+        conn = Connection(api_key, api_secret, session=self.session,
+                          pool_size=self.pool_size, **args)
+        with self.condition:
+            self.accounts[name] = conn
+            self.queues[name] = collections.deque()
+            self.last_call[name] = 0
+        return conn
+
+    def get(self, name):
+        return self.accounts[name]
+
+    def submit(self, name, method, *args, **kwargs):
+        """Queue conn.method(*args, **kwargs) of an account, return a Future."""
+        conn = self.accounts[name]
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.queues[name].append((future, getattr(conn, method), args, kwargs))
+            self.condition.notify()
+        return future
+
+    def next_job(self):
+        """Pop the next call round-robin, None if nothing may run now."""
+        names = list(self.accounts)
+        now = time.monotonic()
+        for step in range(len(names)):
+            index = (self.cursor + step) % len(names)
+            name = names[index]
+            if not self.queues[name]:
+                continue
+            if (not self.accounts[name].has_credits()
+                    and now - self.last_call[name] < self.credit_wait):
+                continue
+            self.cursor = index + 1
+            self.last_call[name] = now
+            return self.queues[name].popleft()
+        return None
+
+    def run_one(self, job):
+        future, func, args, kwargs = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    def work(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None and self.running:
+                    self.condition.wait(self.credit_wait)
+                    job = self.next_job()
+                if job is None:
+                    return
+            self.run_one(job)
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True,
+                                      name=f'btcde-manager-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class RequestScheduler(object):
+    """Run Connection calls by priority class with load shedding.
+
+    Classes in order of priority are cancel, trade, market_data and
+    reporting, each with a bounded queue; a call which does not fit into
+    its queue fails right away with RequestDropped. A call whose deadline
+    passed while it was queued is dropped the same way instead of being
+    sent. While the connection is below its min_credits only cancel and
+    trade calls are sent, other calls only once no call was sent for
+    credit_wait seconds, which also refreshes the credits. Assign it to conn.scheduler to also route
+    cancel_all, replace_order(s) and FillPlan.execute through it."""
+    PRIORITIES = ('cancel', 'trade', 'market_data', 'reporting')
+    CLASSES = {'deleteOrder': 'cancel',
+               'createOrder': 'trade', 'executeTrade': 'trade',
+               'markTradeAsPaid': 'trade', 'markCoinsAsTransferred': 'trade',
+               'markCoinsAsReceived': 'trade', 'markTradeAsPaymentReceived': 'trade',
+               'addTradeRating': 'trade', 'addToAddressPool': 'trade',
+               'removeFromAddressPool': 'trade',
+               'showOrderbook': 'market_data', 'showOrderbookCompact': 'market_data',
+               'showRates': 'market_data', 'showPublicTradeHistory': 'market_data',
+               'showOrderDetails': 'market_data'}
+
+    def __init__(self, conn, workers=None, queue_size=1000, queue_sizes=None,
+                 credit_wait=1):
+        self.conn = conn
+        self.workers = workers or conn.pool_size
+        self.credit_wait = credit_wait
+        sizes = dict.fromkeys(self.PRIORITIES, queue_size)
+        sizes.update(queue_sizes or {})
+        self.sizes = sizes
+        self.queues = {priority: collections.deque() for priority in self.PRIORITIES}
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+        self.last_call = 0
+
+    def submit(self, method, *args, deadline=None, priority=None, **kwargs):
+        """Queue conn.method(*args, **kwargs), return a Future.
+
+        deadline is the number of seconds the call may wait in the queue,
+        priority overrides the class derived from the method name."""
+        if priority is None:
+            priority = self.CLASSES.get(method, 'reporting')
+        if priority not in self.queues:
+            raise ValueError("{} is not any of {}".format(
+                priority, ', '.join(self.PRIORITIES)))
+        func = getattr(self.conn, method)
+        future = concurrent.futures.Future()
+        expires = time.monotonic() + deadline if deadline is not None else None
+        with self.condition:
+            if len(self.queues[priority]) >= self.sizes[priority]:
+                future.set_exception(RequestDropped(
+                    '{} queue is full, dropped {}'.format(priority, method)))
+                return future
+            self.queues[priority].append((future, expires, func, args, kwargs))
+            self.condition.notify()
+        return future
+
+    def next_job(self):
+        """Pop the most important job still within its deadline, or None."""
+        now = time.monotonic()
+        for queue in self.queues.values():
+            if any(job[1] is not None and job[1] < now for job in queue):
+                for job in list(queue):
+                    if job[1] is not None and job[1] < now:
+                        queue.remove(job)
+                        job[0].set_exception(RequestDropped(
+                            'deadline passed, dropped {}'.format(job[2].__name__)))
+        priorities = self.PRIORITIES
+        if (not self.conn.has_credits()
+                and now - self.last_call < self.credit_wait):
+            priorities = ('cancel', 'trade')
+        for priority in priorities:
+            if self.queues[priority]:
+                self.last_call = now
+                return self.queues[priority].popleft()
+        return None
+
+    def run_one(self, job):
+        future, _, func, args, kwargs = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    def work(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None and self.running:
+                    self.condition.wait(self.credit_wait)
+                    job = self.next_job()
+                if job is None:
+                    return
+            self.run_one(job)
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True,
+                                      name=f'btcde-scheduler-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+HISTORY_RECORD = struct.Struct('<d')
+HISTORY_INDEX = struct.Struct('<dQ')
+
+
+class OrderbookHistoryWriter(object):
+    """Store compact order books of a pair as keyframes plus level deltas.
+
+    Records are a timestamp followed by a frame as used by the fan-out
+    server: a snapshot frame every keyframe_interval seconds, delta frames
+    with changed levels in between. The keyframe timestamps and offsets are
+    appended to path + '.idx'."""
+    def __init__(self, path, trading_pair, keyframe_interval=60):
+        self.trading_pair = trading_pair
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        self.levels = None
+        self.last_keyframe = None
+
+    def append(self, timestamp, result):
+        """Add a showOrderbookCompact result received at timestamp."""
+        levels = orderbook_levels(result)
+        if (self.levels is None
+                or timestamp - self.last_keyframe >= self.keyframe_interval):
+            self.index.write(HISTORY_INDEX.pack(timestamp, self.file.tell()))
+            self.index.flush()
+            frame = encode_frame(FRAME_SNAPSHOT, self.trading_pair,
+                                 diff_levels({}, levels))
+            self.last_keyframe = timestamp
+        else:
+            delta = diff_levels(self.levels, levels)
+            if not delta:
+                return
+            frame = encode_frame(FRAME_DELTA, self.trading_pair, delta)
+        self.file.write(HISTORY_RECORD.pack(timestamp) + frame)
+        self.levels = levels
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+class OrderbookHistoryReader(object):
+    """Reconstruct books from an OrderbookHistoryWriter file via mmap."""
+    def __init__(self, path):
+        with open(path + '.idx', 'rb') as f:
+            data = f.read()
+        entries = [HISTORY_INDEX.unpack_from(data, offset) for offset
+                   in range(0, len(data) - HISTORY_INDEX.size + 1, HISTORY_INDEX.size)]
+        self.times = [entry[0] for entry in entries]
+        self.offsets = [entry[1] for entry in entries]
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def records(self, offset=0):
+        """Yield (timestamp, kind, delta) from offset to the end."""
+        size = len(self.map)
+        header = HISTORY_RECORD.size + FRAME_HEADER.size
+        while offset + header <= size:
+            timestamp, = HISTORY_RECORD.unpack_from(self.map, offset)
+            length, kind, pair_length = FRAME_HEADER.unpack_from(
+                self.map, offset + HISTORY_RECORD.size)
+            start = offset + header
+            if start + length > size:
+                # record torn by a crash
+                return
+            kind, _, delta = decode_frame(kind, pair_length,
+                                          self.map[start:start + length])
+            yield timestamp, kind, delta
+            offset = start + length
+
+    def scan(self, start=None, end=None):
+        """Yield (timestamp, levels) of every stored book between start and end.
+
+        The levels dict is updated in place between iterations."""
+        offset = 0
+        if start is not None:
+            position = bisect.bisect_right(self.times, start) - 1
+            offset = self.offsets[max(position, 0)] if self.offsets else 0
+        levels = None
+        for timestamp, kind, delta in self.records(offset):
+            if end is not None and timestamp > end:
+                return
+            if kind == FRAME_SNAPSHOT:
+                levels = {'bids': {}, 'asks': {}}
+            if levels is None:
+                continue
+            apply_levels(levels, delta)
+            if start is None or timestamp >= start:
+                yield timestamp, levels
+
+    def at(self, timestamp):
+        """Levels of the last book stored at or before timestamp, None if there is none."""
+        position = bisect.bisect_right(self.times, timestamp) - 1
+        if position < 0:
+            return None
+        levels = None
+        for record_time, kind, delta in self.records(self.offsets[position]):
+            if record_time > timestamp:
+                break
+            if kind == FRAME_SNAPSHOT:
+                levels = {'bids': {}, 'asks': {}}
+            apply_levels(levels, delta)
+        return levels
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class BulkExporter(object):
+    """Download own trades, orders and account ledgers to files.
+
+    Every dataset (trades, orders, ledger_<currency>) is fetched page by
+    page in its own worker, at most workers at a time on one connection.
+    Workers wait credit_wait seconds before each page while credits are
+    below min_credits, the page itself then refreshes the credits. Output
+    is gzip compressed JSON lines (format 'jsonl') or CSV with nested
+    fields flattened to dotted columns (format 'csv'). Pages are appended
+    to a JSON lines file and after every page the position and file size
+    are saved to <dataset>.state, so an interrupted export continues where
+    it stopped. The listings are newest first, so the first run of a
+    dataset saves its start time as end date and every page is asked up
+    to it; records added meanwhile do not shift the pages. CSV files are written from it once a dataset is complete,
+    with the columns of all its records. progress is called with
+    (dataset, page, last_page, records, records_per_second)."""
+    def __init__(self, conn, directory, currencies=None, format='jsonl',
+                 workers=4, credit_wait=1, progress=None):
+        if format not in ('jsonl', 'csv'):
+            raise ValueError('{} is not any of jsonl, csv'.format(format))
+        self.conn = conn
+        self.directory = directory
+        self.format = format
+        self.workers = workers
+        self.credit_wait = credit_wait
+        self.progress = progress
+        self.datasets = collections.OrderedDict()
+        # method, result key, arguments, segments, end date parameter
+        self.datasets['trades'] = ('showMyTrades', 'trades', (), [{}], 'date_end')
+        self.datasets['orders'] = ('showMyOrders', 'orders', (),
+                                   [{'state': state} for state
+                                    in ParameterBuilder.ORDER_STATES], 'date_end')
+        for currency in currencies or ParameterBuilder.CURRENCIES:
+            self.datasets['ledger_' + currency] = (
+                'showAccountLedger', 'account_ledger', (currency,), [{}],
+                'datetime_end')
+        self.started = None
+        self.records = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, dataset):
+        extension = '.jsonl.gz' if self.format == 'jsonl' else '.csv.gz'
+        return os.path.join(self.directory, dataset + extension)
+
+    def spool_path(self, dataset):
+        if self.format == 'jsonl':
+            return self.path(dataset)
+        return os.path.join(self.directory, dataset + '.spool.jsonl.gz')
+
+    def load_state(self, dataset):
+        try:
+            with open(os.path.join(self.directory, dataset + '.state')) as f:
+                state = json.load(f)
+            # state files of earlier versions have no end date
+            state.setdefault('end', format_datetime(time.time()))
+            return state
+        except FileNotFoundError:
+            return {'segment': 0, 'page': 0, 'size': 0, 'records': 0,
+                    'done': False, 'end': format_datetime(time.time())}
+
+    def save_state(self, dataset, state):
+        path = os.path.join(self.directory, dataset + '.state')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def flatten(entry, prefix=''):
+        row = {}
+        for key, value in entry.items():
+            if isinstance(value, dict):
+                row.update(BulkExporter.flatten(value, prefix + key + '.'))
+            else:
+                row[prefix + key] = value
+        return row
+
+    def write(self, dataset, state, entries):
+        """Append one page as a complete gzip member."""
+        with open(self.spool_path(dataset), 'ab') as f:
+            f.truncate(state['size'])
+            with gzip.GzipFile(fileobj=f, mode='wb') as out:
+                for entry in entries:
+                    out.write(json.dumps(entry, default=str).encode() + b'\n')
+            state['size'] = f.tell()
+
+    def write_csv(self, dataset):
+        """Convert the complete spool file of a dataset to CSV."""
+        spool = self.spool_path(dataset)
+        columns = set()
+        for entry in read_export(spool):
+            columns.update(self.flatten(entry))
+        temporary = self.path(dataset) + '.tmp'
+        with gzip.open(temporary, 'wt', newline='') as f:
+            writer = csv.DictWriter(f, sorted(columns))
+            writer.writeheader()
+            for entry in read_export(spool):
+                writer.writerow(self.flatten(entry))
+        os.replace(temporary, self.path(dataset))
+        os.remove(spool)
+
+    def export(self, dataset):
+        """Fetch the remaining pages of a dataset, True once it is complete."""
+        method, key, args, segments, end = self.datasets[dataset]
+        state = self.load_state(dataset)
+        while not state['done']:
+            if not self.conn.has_credits():
+                time.sleep(self.credit_wait)
+            params = dict(segments[state['segment']], page=state['page'] + 1)
+            params[end] = state['end']
+            r = getattr(self.conn, method)(*args, **params)
+            if key not in r:
+                return False
+            entries = r[key]
+            if entries:
+                self.write(dataset, state, entries)
+            state['page'] += 1
+            state['records'] += len(entries)
+            last = r.get('page', {}).get('last', state['page'])
+            if state['page'] >= last:
+                state['segment'] += 1
+                state['page'] = 0
+                state['done'] = state['segment'] >= len(segments)
+            self.save_state(dataset, state)
+            with self.lock:
+                self.records += len(entries)
+                rate = self.records / max(time.monotonic() - self.started, 1e-9)
+            if self.progress:
+                self.progress(dataset, state['page'] or last, last,
+                              state['records'], rate)
+        if self.format == 'csv' and os.path.exists(self.spool_path(dataset)):
+            self.write_csv(dataset)
+        return True
+
+    def run(self):
+        """Export all datasets, return {dataset: complete}."""
+        self.started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(
+                self.workers, thread_name_prefix='btcde-export') as executor:
+            futures = {dataset: executor.submit(self.export, dataset)
+                       for dataset in self.datasets}
+        return {dataset: future.result() for dataset, future in futures.items()}
+
+
+def read_export(path):
+    """Yield the records of a BulkExporter jsonl file, or rows of a csv file."""
+    with gzip.open(path, 'rt', newline='') as f:
+        if path.endswith('.csv.gz'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                yield json.loads(line)
+
+
+def main(argv=None):
+    """Command line entry point, btcde export."""
+    parser = argparse.ArgumentParser(prog='btcde')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser(
+        'export', help='download own trades, orders and account ledgers')
+    export.add_argument('directory')
+    export.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    export.add_argument('--currency', action='append', dest='currencies',
+                        choices=ParameterBuilder.CURRENCIES,
+                        help='ledger currency, repeatable (default: all)')
+    export.add_argument('--workers', type=int, default=4)
+    export.add_argument('--min-credits', type=int, default=5)
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    api_key = os.environ.get('BTCDE_API_KEY')
+    api_secret = os.environ.get('BTCDE_API_SECRET')
+    if not api_key or not api_secret:
+        parser.error('BTCDE_API_KEY and BTCDE_API_SECRET must be set')
+    conn = Connection(api_key, api_secret, ssl_verify=True,
+                      min_credits=args.min_credits, pool_size=args.workers)
+
+    def progress(dataset, page, last, records, rate):
+        print(f'{dataset}: page {page}/{last}, {records} records, '
+              f'{rate:.1f} records/s', file=sys.stderr)
+
+    exporter = BulkExporter(conn, args.directory, currencies=args.currencies,
+                            format=args.format, workers=args.workers,
+                            progress=progress)
+    results = exporter.run()
+    failed = [dataset for dataset, done in results.items() if not done]
+    if failed:
+        print('incomplete, run again to resume: ' + ', '.join(failed),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 """Setup to install Bitcoin.de API Python Module."""
-from distutils.core import setup
+from setuptools import setup
 setup(name='btcde',
       version='4.1',
       py_modules=['btcde'],
-      install_requires=['requests', 'future'],
+      install_requires=['requests', 'urllib3>=2', 'future'],
       description='API Wrapper for Bitcoin.de Trading API.',
       url='https://github.com/peshay/btcde',
       author='Andreas Hubert',
@@ -20,5 +20,6 @@ setup(name='btcde',
                    'Programming Language :: Python :: 3.10',
                    'Programming Language :: Python :: 3.11', ],
       keywords='bitcoin.de bitcoin btc api',
+      entry_points={'console_scripts': ['btcde = btcde:main']},
 
       )
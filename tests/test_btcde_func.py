@@ -1,8 +1,15 @@
 from unittest import TestCase
 import hashlib
 import hmac
+import requests
 import requests_mock
 import json
+import os
+import tempfile
+import time
+import queue
+import threading
+import concurrent.futures
 import btcde
 from decimal import Decimal
 from unittest.mock import patch
@@ -656,3 +663,1462 @@ class TestBtcdeExceptions(TestCase):
         with self.assertRaises(KeyError) as context:
             self.conn.showMyOrders(foo=4)
         self.assertTrue('foo is not any of' in str(context.exception))
+
+
+@requests_mock.Mocker()
+class TestBtcdeFingerprint(TestCase):
+    '''Tests for skipping decode of unchanged polled responses.'''
+
+    def setUp(self):
+        self.conn = btcde.Connection('f00b4r', 'b4rf00', fingerprint=True)
+        with open('tests/resources/showRates.json') as f:
+            self.body = f.read()
+
+    @patch('btcde.log')
+    def test_invalid_body_same_on_both_paths(self, m, mock_logger):
+        '''A non JSON body gives {} or ServerError with and without fingerprints.'''
+        m.get(requests_mock.ANY, text='<html>maintenance</html>')
+        for fingerprint in (True, False):
+            self.conn.fingerprint = fingerprint
+            self.conn.strict = False
+            self.assertEqual(self.conn.showRates('btceur'), {})
+            self.conn.strict = True
+            with self.assertRaises(btcde.ServerError):
+                self.conn.showRates('btceur')
+
+    def test_fingerprints_bounded(self, m):
+        '''since_tid polls are not fingerprinted, other URLs are bounded.'''
+        m.get(requests_mock.ANY, text=self.body)
+        for tid in range(1, 51):
+            self.conn.showPublicTradeHistory('btceur', since_tid=tid)
+        self.assertEqual(len(self.conn.fingerprints), 0)
+        self.conn.max_fingerprints = 3
+        for page_size in range(1, 6):
+            self.conn.showOrderbook('buy', 'btceur', page_size=page_size)
+        self.assertEqual(len(self.conn.fingerprints), 3)
+        self.assertIn('page_size=5', list(self.conn.fingerprints)[-1])
+
+    @patch('btcde.log')
+    def test_invalid_header_is_transient(self, m, mock_logger):
+        '''Errors raised while sending are not taken for invalid JSON.'''
+        conn = btcde.Connection('f00\nb4r', 'b4rf00', strict=True)
+        with self.assertRaises(btcde.TransientError):
+            conn.showRates('btceur')
+        conn.strict = False
+        self.assertEqual(conn.showRates('btceur'), {})
+        self.assertEqual(m.request_history, [])
+
+    def test_unchanged_body_reuses_result(self, m):
+        '''Second identical body is flagged unchanged with fresh credits.'''
+        changes = []
+        self.conn.on_change(lambda url, result: changes.append(url))
+        m.get(requests_mock.ANY, [
+            {'text': self.body, 'status_code': 200},
+            {'text': self.body.replace('"credits":19', '"credits":18'), 'status_code': 200}])
+        first = self.conn.showRates('btceur')
+        second = self.conn.showRates('btceur')
+        self.assertFalse(first.unchanged)
+        self.assertTrue(second.unchanged)
+        self.assertEqual(second['credits'], 18)
+        self.assertIs(second['rates'], first['rates'])
+        self.assertEqual(len(changes), 1)
+
+    def test_changed_body_is_decoded(self, m):
+        '''A changed body is decoded again and listeners are notified.'''
+        changes = []
+        self.conn.on_change(lambda url, result: changes.append(result))
+        m.get(requests_mock.ANY, [
+            {'text': self.body, 'status_code': 200},
+            {'text': self.body.replace('257.3999269', '260'), 'status_code': 200}])
+        self.conn.showRates('btceur')
+        second = self.conn.showRates('btceur')
+        self.assertFalse(second.unchanged)
+        self.assertEqual(second['rates']['rate_weighted'], '260')
+        self.assertEqual(len(changes), 2)
+
+    def test_not_polled_endpoint(self, m):
+        '''Endpoints outside POLLED_ENDPOINTS are decoded as before.'''
+        m.get(requests_mock.ANY, text=self.body, status_code=200)
+        result = self.conn.showAccountInfo()
+        self.assertNotIsInstance(result, btcde.PolledResult)
+
+
+class TestBtcdeReplay(TestCase):
+    '''Tests for recording and replaying market data.'''
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    @requests_mock.Mocker()
+    def record(self, m):
+        with open('tests/resources/showRates.json') as f:
+            m.get(requests_mock.ANY, text=f.read(), status_code=200)
+        with btcde.MarketDataRecorder(self.path) as recorder:
+            conn = btcde.Connection('f00b4r', 'b4rf00', recorder=recorder)
+            conn.showRates('btceur')
+            conn.showRates('btceur')
+            conn.showAccountInfo()
+
+    def test_record_only_market_data(self):
+        '''Only market data endpoints end up in the capture.'''
+        self.record()
+        records = list(btcde.read_capture(self.path))
+        self.assertEqual(len(records), 2)
+        self.assertTrue(records[0]['url'].endswith('/btceur/rates'))
+
+    def test_replay(self):
+        '''Replay returns recorded responses and then runs out.'''
+        self.record()
+        replay = btcde.MarketDataReplay(self.path)
+        for _ in range(2):
+            rates = replay.showRates('btceur')
+            self.assertEqual(rates['rates']['rate_weighted_3h'], '258.93994247')
+            self.assertEqual(rates['credits'], 19)
+        with self.assertRaises(btcde.ReplayExhausted):
+            replay.showRates('btceur')
+
+
+@patch('btcde.log')
+class TestBtcdeSimulatedExchange(TestCase):
+    '''Tests for the backtesting exchange.'''
+
+    def sampleData(self, file):
+        '''Retrieve sample data from json files.'''
+        with open('tests/resources/{}.json'.format(file)) as f:
+            return json.load(f, parse_float=Decimal)
+
+    def setUp(self):
+        self.sim = btcde.SimulatedExchange()
+
+    def test_resting_order_fills_against_book(self, mock_logger):
+        '''Own buy order is filled by asks at or below its price.'''
+        order_id = self.sim.createOrder('buy', 'btceur', '0.4', '260')['order_id']
+        self.sim.apply_orderbook_compact('btceur', self.sampleData('showOrderbookCompact'))
+        trades = self.sim.showMyTrades()['trades']
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades[0]['amount'], Decimal('0.2'))
+        order = self.sim.showMyOrders(state=0)['orders'][0]
+        self.assertEqual(order['order_id'], order_id)
+        self.assertEqual(order['max_amount'], Decimal('0.2'))
+
+    def test_delete_order(self, mock_logger):
+        '''Deleted orders are not matched any more.'''
+        order_id = self.sim.createOrder('sell', 'btceur', '1', '190')['order_id']
+        self.assertEqual(self.sim.deleteOrder(order_id, 'btceur')['errors'], [])
+        self.sim.apply_orderbook_compact('btceur', self.sampleData('showOrderbookCompact'))
+        self.assertEqual(self.sim.showMyTrades()['trades'], [])
+        self.assertEqual(self.sim.deleteOrder(order_id, 'btceur'), {})
+        self.assertTrue(mock_logger.warning.called)
+
+    def test_execute_trade(self, mock_logger):
+        '''executeTrade takes an offer of the applied orderbook.'''
+        self.sim.apply_orderbook('btceur', self.sampleData('showOrderbook_buy'))
+        result = self.sim.executeTrade('btceur', 'A1B2D3', 'buy', '0.06')
+        self.assertIn('trade_id', result)
+        self.assertEqual(self.sim.executeTrade('btceur', 'A1B2D3', 'buy', '1'), {})
+
+    def test_invalid_state(self, mock_logger):
+        '''Parameters are validated like on Connection.'''
+        with self.assertRaises(ValueError):
+            self.sim.showMyOrders(state=1)
+
+    def test_parameter_sweep(self, mock_logger):
+        '''Parameter sets are evaluated in worker processes.'''
+        self.assertEqual(btcde.run_parameter_sweep(abs, [-1, 2], processes=2), [1, 2])
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeHedging(TestCase):
+    '''Tests for hedged requests and circuit breakers.'''
+
+    def setUp(self):
+        with open('tests/resources/showRates.json') as f:
+            self.body = f.read()
+
+    def test_slow_request_is_hedged(self, mock_logger, m):
+        '''A duplicate request with a fresh nonce answers a slow call.'''
+        nonces = []
+        closed = []
+
+        def send_request(url, method, header, encoded_string):
+            # requests_mock serializes requests, so answer directly
+            nonces.append(header['X-API-NONCE'])
+            slow = len(nonces) == 1
+            if slow:
+                time.sleep(0.5)
+            r = requests.Response()
+            r.status_code = 200
+            r._content = self.body.encode()
+            r.close = lambda: closed.append(slow)
+            return r
+        conn = btcde.Connection('f00b4r', 'b4rf00', hedge_percentile=0.9)
+        conn.send_request = send_request
+        endpoint = 'https://api.bitcoin.de/v4/btceur/rates'
+        for _ in range(20):
+            conn.get_latency(endpoint).add(0.01)
+        start = time.monotonic()
+        result = conn.showRates('btceur')
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(result['credits'], 19)
+        self.assertEqual(len(set(nonces)), 2)
+        # the slow loser is released once it arrives
+        deadline = time.monotonic() + 2
+        while not closed and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(closed, [True])
+
+    def test_no_hedge_without_credits(self, mock_logger, m):
+        '''No duplicate is sent when the credit reserve is reached.'''
+        m.get(requests_mock.ANY, text=self.body, status_code=200)
+        conn = btcde.Connection('f00b4r', 'b4rf00', hedge_percentile=0.9,
+                                min_credits=20)
+        conn.showRates('btceur')
+        self.assertEqual(conn.credits, 19)
+        self.assertFalse(conn.has_credits())
+
+    def test_circuit_breaker_fails_fast(self, mock_logger, m):
+        '''After threshold server errors no further request is sent.'''
+        m.get(requests_mock.ANY, json={'errors': [{'code': 1, 'message': 'down'}]},
+              status_code=503)
+        conn = btcde.Connection('f00b4r', 'b4rf00', breaker_threshold=2)
+        for _ in range(3):
+            self.assertEqual(conn.showRates('btceur'), {})
+        self.assertEqual(len(m.request_history), 2)
+
+    def test_per_endpoint_state_bounded(self, mock_logger, m):
+        '''Calls with different ids share the tracker and breaker of their endpoint.'''
+        m.delete(requests_mock.ANY, json={'errors': [{'code': 1, 'message': 'down'}]},
+                 status_code=503)
+        conn = btcde.Connection('f00b4r', 'b4rf00', breaker_threshold=2)
+        for i in range(5):
+            conn.deleteOrder(f'ID{i}', 'btceur')
+        self.assertEqual(list(conn.latencies),
+                         ['https://api.bitcoin.de/v4/btceur/orders/{id}'])
+        self.assertEqual(len(conn.breakers), 1)
+        self.assertEqual(len(m.request_history), 2)
+
+    def test_nonce_increases_across_threads(self, mock_logger, m):
+        '''Concurrent signing never reuses a nonce.'''
+        conn = btcde.Connection('f00b4r', 'b4rf00')
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            headers = list(executor.map(
+                lambda _: conn.set_header('url', 'GET', ''), range(200)))
+        self.assertEqual(len({h['X-API-NONCE'] for h in headers}), 200)
+
+    def test_per_endpoint_state_shared_across_threads(self, mock_logger, m):
+        '''Concurrent first calls of an endpoint share one tracker and breaker.'''
+        conn = btcde.Connection('f00b4r', 'b4rf00', breaker_threshold=2)
+        barrier = threading.Barrier(8)
+
+        def lookup(_):
+            barrier.wait()
+            return conn.get_latency('url'), conn.get_breaker('url')
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            found = set(executor.map(lookup, range(8)))
+        self.assertEqual(len(found), 1)
+
+    def test_concurrent_recording(self, mock_logger, m):
+        '''Responses recorded from several threads are all kept intact.'''
+        m.get(requests_mock.ANY, json={'errors': [], 'credits': 20})
+        path = os.path.join(tempfile.mkdtemp(), 'capture.gz')
+        recorder = btcde.MarketDataRecorder(path, flush_every=7)
+        conn = btcde.Connection('f00b4r', 'b4rf00', recorder=recorder)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda _: conn.showRates('btceur'), range(50)))
+        recorder.close()
+        self.assertEqual(len(list(btcde.read_capture(path))), 50)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdePollingScheduler(TestCase):
+    '''Tests for the adaptive polling scheduler.'''
+
+    def setUp(self):
+        self.conn = btcde.Connection('f00b4r', 'b4rf00')
+        self.scheduler = btcde.PollingScheduler(self.conn, spacing=0)
+
+    def test_interval_adapts_to_changes(self, mock_logger, m):
+        '''Unchanged data backs off, changed data is delivered.'''
+        with open('tests/resources/showRates.json') as f:
+            m.get(requests_mock.ANY, text=f.read(), status_code=200)
+        results = queue.Queue()
+        sub = self.scheduler.subscribe('btceur', 'showRates', 1, 8, queue=results)
+        self.assertIsNotNone(self.scheduler.run_pending())
+        self.assertEqual(sub.interval, 1)
+        self.scheduler.poll(sub)
+        self.assertEqual(sub.interval, 1.5)
+        self.assertEqual(results.qsize(), 1)
+
+    def test_trade_history_since_tid(self, mock_logger, m):
+        '''Follow-up polls only ask for newer trades.'''
+        with open('tests/resources/showPublicTradeHistory.json') as f:
+            m.get(requests_mock.ANY, text=f.read(), status_code=200)
+        calls = []
+        sub = self.scheduler.subscribe('btceur', 'showPublicTradeHistory',
+                                       callback=lambda s, r: calls.append(r))
+        self.scheduler.poll(sub)
+        self.scheduler.poll(sub)
+        self.assertEqual(sub.since_tid, 1252023)
+        self.assertIn('since_tid=1252023', m.request_history[1].url)
+        self.assertEqual(len(calls), 2)
+
+    def test_invalid_subscription(self, mock_logger, m):
+        '''Only market data endpoints and known pairs can be subscribed.'''
+        with self.assertRaises(ValueError):
+            self.scheduler.subscribe('btceur', 'showMyOrders')
+        with self.assertRaises(ValueError):
+            self.scheduler.subscribe('usdeur', 'showRates')
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeOrderTracker(TestCase):
+    '''Tests for the local order tracker.'''
+
+    def setUp(self):
+        self.tracker = btcde.OrderTracker(btcde.Connection('f00b4r', 'b4rf00'))
+
+    def test_create_and_delete(self, mock_logger, m):
+        '''Created orders are open until deleted.'''
+        m.post(requests_mock.ANY, json={'order_id': 'A1234BC', 'errors': [], 'credits': 8},
+               status_code=201)
+        m.delete(requests_mock.ANY, json={'errors': [], 'credits': 7}, status_code=200)
+        self.tracker.createOrder('buy', 'btceur', 1, 250)
+        self.assertEqual([o['order_id'] for o in self.tracker.open_orders('btceur')],
+                         ['A1234BC'])
+        self.assertEqual(self.tracker.open_orders('etheur'), [])
+        self.tracker.deleteOrder('A1234BC', 'btceur')
+        self.assertEqual(self.tracker.open_orders(), [])
+        self.assertEqual(self.tracker.get('A1234BC')['state'], -1)
+
+    def test_reconcile(self, mock_logger, m):
+        '''Reconcile adds new pending orders and closes vanished ones.'''
+        m.post(requests_mock.ANY, json={'order_id': 'GONE', 'errors': [], 'credits': 8},
+               status_code=201)
+        self.tracker.createOrder('buy', 'btceur', 1, 250)
+        with open('tests/resources/showMyOrderDetails.json') as f:
+            details = json.load(f)
+        details['order']['state'] = -2
+        pending = {'orders': [{'order_id': 'NEW', 'trading_pair': 'btceur',
+                               'type': 'sell', 'state': 0,
+                               'created_at': '2015-01-10T15:00:00+02:00'}],
+                   'page': {'current': 1, 'last': 1}, 'errors': [], 'credits': 5}
+        m.get(requests_mock.ANY, json=pending)
+        m.get('https://api.bitcoin.de/v4/btceur/orders/GONE', json=details)
+        self.assertTrue(self.tracker.reconcile())
+        self.assertEqual([o['order_id'] for o in self.tracker.open_orders()], ['NEW'])
+        self.assertEqual(self.tracker.get('GONE')['state'], -2)
+        self.assertIn('state=0', m.request_history[1].url)
+        self.assertNotIn('date_start=', m.request_history[1].url)
+        self.assertTrue(self.tracker.reconcile())
+        self.assertIn('date_start=', m.request_history[-1].url)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeMassCancel(TestCase):
+    '''Tests for parallel cancel and replace.'''
+
+    def sampleData(self, file):
+        '''Retrieve sample data from json files.'''
+        with open('tests/resources/{}.json'.format(file)) as f:
+            return json.load(f)
+
+    def setUp(self):
+        self.conn = btcde.Connection('f00b4r', 'b4rf00')
+
+    def test_cancel_all(self, mock_logger, m):
+        '''All pending orders are deleted and reported per order.'''
+        orders = {'orders': [{'order_id': 'A1', 'trading_pair': 'btceur'},
+                             {'order_id': 'B2', 'trading_pair': 'btceur'}],
+                  'page': {'current': 1, 'last': 1}, 'errors': [], 'credits': 9}
+        m.get(requests_mock.ANY, json=orders)
+        m.delete('https://api.bitcoin.de/v4/btceur/orders/A1', json={'errors': [], 'credits': 8})
+        m.delete('https://api.bitcoin.de/v4/btceur/orders/B2', json=self.sampleData('error'),
+                 status_code=404)
+        report = self.conn.cancel_all(trading_pair='btceur', type='buy')
+        self.assertIn('state=0', m.request_history[0].url)
+        self.assertIn('type=buy', m.request_history[0].url)
+        self.assertEqual(report['A1'], {'errors': [], 'credits': 8})
+        self.assertEqual(report['B2'], {})
+        self.assertTrue(report.complete)
+
+    def test_cancel_all_listing_failed(self, mock_logger, m):
+        '''A failed page of the listing marks the report incomplete.'''
+        orders = {'orders': [{'order_id': 'A1', 'trading_pair': 'btceur'}],
+                  'page': {'current': 1, 'last': 2}, 'errors': [], 'credits': 9}
+        m.get(requests_mock.ANY, json=orders)
+        m.get(requests_mock.ANY, additional_matcher=lambda r: 'page=2' in r.url,
+              json=self.sampleData('error'), status_code=500)
+        m.delete(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        report = self.conn.cancel_all(trading_pair='btceur')
+        self.assertEqual(list(report), ['A1'])
+        self.assertFalse(report.complete)
+        mock_logger.warning.assert_called()
+
+    def test_cancel_all_listing_failed_strict(self, mock_logger, m):
+        '''In strict mode the listing error is raised before deleting.'''
+        m.get(requests_mock.ANY, json=self.sampleData('error'), status_code=500)
+        conn = btcde.Connection('abc', 'def', strict=True)
+        with self.assertRaises(btcde.APIError):
+            conn.cancel_all(trading_pair='btceur')
+        self.assertFalse([r for r in m.request_history if r.method == 'DELETE'])
+
+    def test_replace_order(self, mock_logger, m):
+        '''Delete and create are both sent and reported.'''
+        m.delete(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        m.post(requests_mock.ANY, json={'order_id': 'NEW', 'errors': [], 'credits': 7},
+               status_code=201)
+        report = self.conn.replace_order('OLD', 'btceur', 'sell', 1, 300,
+                                         min_amount_currency_to_trade=0.5)
+        self.assertEqual(report['order_id'], 'OLD')
+        self.assertEqual(report['created']['order_id'], 'NEW')
+        self.assertEqual(report['deleted']['errors'], [])
+        self.assertEqual(len(m.request_history), 2)
+
+    def test_tracker_cancel_all(self, mock_logger, m):
+        '''The tracker deletes its open orders without listing them.'''
+        m.post(requests_mock.ANY, json={'order_id': 'A1', 'errors': [], 'credits': 8},
+               status_code=201)
+        m.delete(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        tracker = btcde.OrderTracker(self.conn)
+        tracker.createOrder('buy', 'btceur', 1, 250)
+        self.assertTrue(tracker.cancel_all(type='buy')['A1'])
+        self.assertEqual(tracker.open_orders(), [])
+        self.assertEqual([r.method for r in m.request_history], ['POST', 'DELETE'])
+
+
+class TestBtcdeOrderbookQueryPlanner(TestCase):
+    '''Tests for merging concurrent showOrderbook queries.'''
+
+    def setUp(self):
+        def offer(order_id, price, seat, kyc, min_amount='0.1', max_amount='1'):
+            return {'order_id': order_id, 'price': Decimal(price),
+                    'min_amount': Decimal(min_amount), 'max_amount': Decimal(max_amount),
+                    'order_requirements_fullfilled': True,
+                    'trading_partner_information': {'seat_of_bank': seat,
+                                                    'is_kyc_full': kyc}}
+        self.offers = [offer('A', '100', 'DE', True), offer('B', '105', 'NL', False),
+                       offer('C', '110', 'DE', False, '0.5', '2')]
+        self.conn = btcde.Connection('abc', 'def')
+        self.calls = []
+
+        def showOrderbook(order_type, trading_pair, **args):
+            self.calls.append(args)
+            offers = [o for o in self.offers if args.get('seat_of_bank') in
+                      (None, o['trading_partner_information']['seat_of_bank'])]
+            return {'orders': offers, 'errors': [], 'credits': 10}
+        self.conn.showOrderbook = showOrderbook
+        self.planner = btcde.OrderbookQueryPlanner(self.conn, window=0.2)
+
+    def query(self, **args):
+        return self.planner.showOrderbook('buy', 'btceur', payment_option=1, **args)
+
+    def test_concurrent_queries_share_one_request(self):
+        '''Each caller gets its own filtered answer from one fetch.'''
+        queries = [{'seat_of_bank': 'DE', 'only_kyc_full': True},
+                   {'seat_of_bank': 'DE', 'price': 105},
+                   {'seat_of_bank': 'DE', 'amount_currency_to_trade': '1.5'}]
+        with concurrent.futures.ThreadPoolExecutor(3) as executor:
+            futures = [executor.submit(self.query, **args) for args in queries]
+            results = [f.result(timeout=5) for f in futures]
+        self.assertEqual(self.calls, [{'payment_option': 1, 'seat_of_bank': 'DE'}])
+        self.assertEqual([[o['order_id'] for o in r['orders']] for r in results],
+                         [['A'], ['A'], ['C']])
+        self.assertEqual(results[0]['credits'], 10)
+
+    def test_other_parameters_not_merged(self):
+        '''Queries differing in filters not checked client-side are separate.'''
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            first = executor.submit(self.query)
+            second = executor.submit(self.planner.showOrderbook, 'buy', 'btceur',
+                                     payment_option=2)
+            first.result(timeout=5), second.result(timeout=5)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_page_size_not_merged(self):
+        '''With page_size every caller gets the top offers of its own filters.'''
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            first = executor.submit(self.query, page_size=2)
+            second = executor.submit(self.query, page_size=2, seat_of_bank='DE')
+            first.result(timeout=5), second.result(timeout=5)
+        self.assertEqual(sorted(len(c) for c in self.calls), [2, 3])
+        self.assertIn({'payment_option': 1, 'page_size': 2, 'seat_of_bank': 'DE'},
+                      self.calls)
+
+    def test_invalid_parameters(self):
+        '''Invalid parameters fail in the calling thread.'''
+        with self.assertRaises(KeyError):
+            self.query(min_trust_level='gold')
+        self.assertEqual(self.calls, [])
+
+    def test_filter_error_reaches_every_caller(self):
+        '''An offer that cannot be filtered fails all callers of the batch.'''
+        del self.offers[0]['min_amount']
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(self.query, price=price) for price in (100, 105)]
+            for future in futures:
+                with self.assertRaises(KeyError):
+                    future.result(timeout=5)
+        self.assertEqual(len(self.calls), 1)
+
+
+class TestBtcdeFillPlanner(TestCase):
+    '''Tests for planning fills over showOrderbook results.'''
+
+    def setUp(self):
+        offer = {'order_requirements': {'min_trust_level': 'bronze',
+                                        'payment_option': 3}}
+        self.orderbook = {'orders': [
+            dict(offer, order_id='CHEAP', price=Decimal('100'),
+                 min_amount=Decimal('0.5'), max_amount=Decimal('1')),
+            dict(offer, order_id='MID', price=Decimal('110'),
+                 min_amount=Decimal('0.1'), max_amount=Decimal('2')),
+            {'order_id': 'GOLD', 'price': Decimal('90'), 'min_amount': Decimal('0.1'),
+             'max_amount': Decimal('5'),
+             'order_requirements': {'min_trust_level': 'gold', 'seat_of_bank': ['NL']}}]}
+
+    def test_cheapest_eligible_offers(self):
+        '''Offers with unmet requirements are skipped, cheapest first.'''
+        plan = btcde.FillPlanner(self.orderbook).plan('buy', '1.5', trust_level='silver')
+        self.assertEqual([leg[0] for leg in plan.legs], ['CHEAP', 'MID'])
+        self.assertEqual(plan.amount, Decimal('1.5'))
+        self.assertEqual(plan.price, Decimal('155') / Decimal('1.5'))
+
+    def test_min_amount_respected(self):
+        '''An offer is not taken below its min_amount.'''
+        plan = btcde.FillPlanner(self.orderbook).plan('buy', '0.2', seat_of_bank='DE')
+        self.assertEqual(plan.legs, [('MID', Decimal('0.2'), Decimal('110'))])
+
+    def test_min_amount_backtracking(self):
+        '''A full fill is found when the best offer would block the next one.'''
+        orderbook = {'orders': [
+            {'order_id': 'A', 'price': 100, 'min_amount': '0.8', 'max_amount': '0.9'},
+            {'order_id': 'B', 'price': 101, 'min_amount': '0.5', 'max_amount': '1.0'}]}
+        plan = btcde.FillPlanner(orderbook).plan('buy', '1.0')
+        self.assertTrue(plan.complete)
+        self.assertEqual(plan.legs, [('B', Decimal('1.0'), Decimal('101'))])
+        plan = btcde.FillPlanner(orderbook).plan('buy', '1.4')
+        self.assertEqual(plan.legs, [('A', Decimal('0.9'), Decimal('100')),
+                                     ('B', Decimal('0.5'), Decimal('101'))])
+
+    def test_search_only_when_blocked(self):
+        '''The best price walk is used as is, the search prunes costly branches.'''
+        orderbook = {'orders': [{'order_id': str(i), 'price': 100 + i, 'min_amount': '0.01',
+                                 'max_amount': '0.1'} for i in range(200)]}
+        planner = btcde.FillPlanner(orderbook)
+        planner.max_nodes = 0
+        plan = planner.plan('buy', '5')
+        self.assertTrue(plan.complete)
+        self.assertEqual([leg[0] for leg in plan.legs], [str(i) for i in range(50)])
+        for offer in orderbook['orders']:
+            offer['min_amount'] = '0.06'
+        orderbook['orders'][0].update(min_amount='0.1', max_amount='5')
+        planner = btcde.FillPlanner(orderbook)
+        planner.max_nodes = 100
+        plan = planner.plan('buy', '5.05')
+        self.assertEqual(plan.legs, [('0', Decimal('4.99'), Decimal('100')),
+                                     ('1', Decimal('0.06'), Decimal('101'))])
+
+    @patch('btcde.log')
+    def test_shortfall(self, mock_logger):
+        '''An incomplete plan reports its shortfall and is not executed.'''
+        plan = btcde.FillPlanner(self.orderbook).plan('buy', '10', trust_level='silver')
+        self.assertFalse(plan.complete)
+        self.assertEqual(plan.shortfall, Decimal('7'))
+        self.assertEqual(plan.execute(btcde.Connection('f00b4r', 'b4rf00'), 'btceur'), {})
+
+    def test_sell_prefers_highest_price(self):
+        '''Selling walks offers from the highest price.'''
+        plan = btcde.FillPlanner(self.orderbook).plan('sell', '1', trust_level='platin')
+        self.assertEqual(plan.legs[0][0], 'MID')
+
+    @patch('btcde.log')
+    @requests_mock.Mocker()
+    def test_execute(self, mock_logger, m):
+        '''All legs are sent as executeTrade calls.'''
+        m.post(requests_mock.ANY, json={'errors': [], 'credits': 8}, status_code=201)
+        plan = btcde.FillPlanner(self.orderbook).plan('buy', '1.5', trust_level='bronze')
+        report = plan.execute(btcde.Connection('f00b4r', 'b4rf00'), 'btceur')
+        self.assertEqual(set(report), {'CHEAP', 'MID'})
+        self.assertEqual(len(m.request_history), 2)
+
+
+class TestBtcdeRateGraph(TestCase):
+    '''Tests for cross rates and triangular spreads.'''
+
+    def setUp(self):
+        self.graph = btcde.RateGraph()
+
+    def test_split_trading_pair(self):
+        '''Pairs are split into base and quote currency.'''
+        self.assertEqual(btcde.split_trading_pair('btcusdt'), ('btc', 'usdt'))
+        self.assertEqual(btcde.split_trading_pair('iotabtc'), ('iota', 'btc'))
+        with self.assertRaises(ValueError):
+            btcde.split_trading_pair('eur')
+
+    def test_triangle_spread(self):
+        '''A mispriced triangle shows up as opportunity.'''
+        self.graph.update('btceur', 20000, 20000)
+        self.graph.update('usdteur', 1, 1)
+        self.graph.update('btcusdt', 21000, 21000)
+        best = self.graph.opportunities()[0]
+        self.assertAlmostEqual(best[0], 0.05)
+        self.assertEqual(set(best[1]), {'btc', 'eur', 'usdt'})
+        self.assertAlmostEqual(self.graph.implied_rate('btc', 'eur'), 21000)
+
+    def test_cycles_stored_once(self):
+        '''Every pair of a triangle updates the same cycles.'''
+        self.graph.update('btceur', 20000, 20000)
+        self.graph.update('usdteur', 1, 1)
+        self.graph.update('btcusdt', 20000, 20000)
+        self.graph.update('btcusdt', 21000, 21000)
+        spreads = sorted(spread for spread, cycle in self.graph.opportunities(-1)
+                         if set(cycle) == {'btc', 'eur', 'usdt'})
+        self.assertEqual(len(spreads), 2)
+        self.assertAlmostEqual(spreads[0], 20000 / 21000 - 1)
+        self.assertAlmostEqual(spreads[1], 0.05)
+
+    def test_update_from_responses(self):
+        '''Compact orderbook and rates responses update the graph.'''
+        with open('tests/resources/showOrderbookCompact.json') as f:
+            self.graph.update_orderbook_compact('btceur', json.load(f, parse_float=Decimal))
+        self.assertEqual(self.graph.rate('btc', 'eur'), 205)
+        self.assertAlmostEqual(self.graph.rate('eur', 'btc'), 1 / 250)
+        with open('tests/resources/showRates.json') as f:
+            self.graph.update_rates('ltceur', json.load(f))
+        self.assertAlmostEqual(self.graph.rate('ltc', 'eur'), 257.3999269)
+
+
+class TestBtcdeCandleBuilder(TestCase):
+    '''Tests for incremental candles.'''
+
+    def setUp(self):
+        self.builder = btcde.CandleBuilder(resolutions=(60, 3600), size=3)
+        with open('tests/resources/showPublicTradeHistory.json') as f:
+            self.trades = json.load(f, parse_float=Decimal)['trades']
+
+    def test_duplicates_are_ignored(self):
+        '''The same trade is only counted once.'''
+        self.assertEqual(self.builder.add_trades('btceur', self.trades), 2)
+        self.assertEqual(self.builder.add_trades('btceur', self.trades), 0)
+        self.assertEqual(self.builder.last_tid('btceur'), 1252023)
+        bar = self.builder.candles('btceur', 3600)[-1]
+        self.assertEqual(bar['volume'], Decimal('3.1'))
+        self.assertEqual((bar['open'], bar['close']), (230, Decimal('200.1')))
+
+    def test_late_trade_updates_bar(self):
+        '''A late trade with a lower tid becomes the open of its bar.'''
+        self.builder.add_trades('btceur', self.trades)
+        late = {'date': 1435922640, 'price': 250, 'amount': '1', 'tid': 1252000}
+        self.builder.add_trades('btceur', [late])
+        bar = self.builder.candles('btceur', 3600)[-1]
+        self.assertEqual((bar['open'], bar['high'], bar['trades']), (250, 250, 3))
+
+    def test_ring_buffer_is_bounded(self):
+        '''Old bars are overwritten and too old trades dropped.'''
+        trades = [{'date': 60 * i, 'price': i, 'amount': '1', 'tid': i}
+                  for i in range(1, 6)]
+        self.builder.add_trades('btceur', trades)
+        bars = self.builder.candles('btceur', 60)
+        self.assertEqual([b['start'] for b in bars], [180, 240, 300])
+        self.builder.add_trades('btceur', [{'date': 60, 'price': 9,
+                                            'amount': '1', 'tid': 99}])
+        self.assertEqual(len(self.builder.candles('btceur', 60)), 3)
+
+
+class TestBtcdeMarketDataBus(TestCase):
+    '''Tests for the memory-mapped market data bus.'''
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.bus')
+        os.close(fd)
+        self.publisher = btcde.MarketDataPublisher(self.path, ['btceur'], depth=2)
+        self.reader = btcde.MarketDataBusReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.publisher.close()
+        os.remove(self.path)
+
+    def test_nothing_published(self):
+        '''Reading before the first snapshot returns an empty result.'''
+        self.assertEqual(self.reader.showRates('btceur'), {})
+
+    @patch('btcde.log')
+    @requests_mock.Mocker()
+    def test_publish_and_read(self, mock_logger, m):
+        '''Snapshots polled by a Connection are readable from the bus.'''
+        with open('tests/resources/showRates.json') as f:
+            m.get(requests_mock.ANY, text=f.read())
+        conn = btcde.Connection('f00b4r', 'b4rf00', recorder=self.publisher)
+        for _ in range(3):
+            conn.showRates('btceur')
+            rates = self.reader.showRates('btceur')
+            self.assertFalse(rates.unchanged)
+            self.assertEqual(rates['rates']['rate_weighted'], '257.3999269')
+        self.assertTrue(self.reader.showRates('btceur').unchanged)
+        self.assertEqual(self.reader.read('btceur/rates')[0], 3)
+
+    def test_oversized_snapshot_is_skipped(self):
+        '''Snapshots larger than a slot are not published.'''
+        with patch('btcde.log'):
+            self.assertFalse(self.publisher.publish('btceur/rates', b'x' * 70000))
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeOrderbookDeltas(TestCase):
+    '''Tests for order book deltas and the fan-out server.'''
+
+    def setUp(self):
+        with open('tests/resources/showOrderbookCompact.json') as f:
+            self.book = json.load(f, parse_float=Decimal)
+        self.changed = json.loads(json.dumps(self.book, default=str), parse_float=Decimal)
+        self.changed['orders']['bids'] = [{'price': Decimal('206'), 'amount': Decimal('1.5')}]
+
+    def test_diff_and_frames(self, mock_logger, m):
+        '''Deltas survive the binary encoding and rebuild the book.'''
+        old = btcde.orderbook_levels(self.book)
+        new = btcde.orderbook_levels(self.changed)
+        delta = btcde.diff_levels(old, new)
+        self.assertEqual(len(delta), 3)
+        frame = btcde.encode_frame(btcde.FRAME_DELTA, 'btceur', delta)
+        length, kind, pair_length = btcde.FRAME_HEADER.unpack_from(frame)
+        decoded = btcde.decode_frame(kind, pair_length, frame[btcde.FRAME_HEADER.size:])
+        self.assertEqual(decoded, (btcde.FRAME_DELTA, 'btceur', delta))
+        self.assertEqual(btcde.apply_levels(old, decoded[2]), new)
+
+    def test_snapshot_then_deltas(self, mock_logger, m):
+        '''Subscribers get a snapshot on connect and deltas afterwards.'''
+        m.get(requests_mock.ANY, [{'json': json.loads(json.dumps(self.book, default=float))},
+                                  {'json': json.loads(json.dumps(self.changed, default=float))}])
+        path = os.path.join(tempfile.mkdtemp(), 'fanout.sock')
+        server = btcde.OrderbookDeltaServer(btcde.Connection('f00b4r', 'b4rf00'),
+                                            path, ['btceur'])
+        try:
+            server.poll_once()
+            client = btcde.OrderbookDeltaClient(path)
+            server.accept()
+            self.assertEqual(client.receive()[0], btcde.FRAME_SNAPSHOT)
+            book = client.showOrderbookCompact('btceur')['orders']
+            self.assertEqual(book['bids'][0]['price'], Decimal('205'))
+            server.poll_once()
+            kind, pair, delta = client.receive()
+            self.assertEqual((kind, pair, len(delta)), (btcde.FRAME_DELTA, 'btceur', 3))
+            book = client.showOrderbookCompact('btceur')['orders']
+            self.assertEqual(book['bids'], [{'price': Decimal('206'), 'amount': Decimal('1.5')}])
+            client.close()
+        finally:
+            server.stop()
+
+    def test_poll_errors_keep_server_running(self, mock_logger, m):
+        '''A failing poll is logged and the poll thread carries on.'''
+        m.get(requests_mock.ANY, text='not json')
+        conn = btcde.Connection('f00b4r', 'b4rf00', fingerprint=True, strict=True)
+        path = os.path.join(tempfile.mkdtemp(), 'fanout.sock')
+        server = btcde.OrderbookDeltaServer(conn, path, ['btceur'], interval=0.01)
+        server.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(m.request_history) < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertGreaterEqual(len(m.request_history), 3)
+        finally:
+            server.stop()
+        self.assertEqual(server.threads, [])
+        self.assertTrue(mock_logger.warning.called)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeLedgerEngine(TestCase):
+    '''Tests for the incremental ledger engine.'''
+
+    def setUp(self):
+        with open('tests/resources/showAccountLedger.json') as f:
+            self.ledger = json.load(f)
+        self.path = os.path.join(tempfile.mkdtemp(), 'ledger.json')
+
+    def test_balances_fees_and_pnl(self, mock_logger, m):
+        '''Entries update balance, fees and realized PnL once.'''
+        engine = btcde.LedgerEngine()
+        entries = self.ledger['account_ledger']
+        self.assertEqual(engine.consume('btc', entries), 4)
+        self.assertEqual(engine.consume('btc', entries), 0)
+        state = engine.get('btc')
+        self.assertEqual(state['balance'], Decimal('3.00019794'))
+        self.assertEqual(state['fees'], Decimal('0.02272766'))
+        self.assertEqual(round(state['realized'], 6), Decimal('-1.485285'))
+        self.assertEqual(state['position'], 0)
+        self.assertEqual(state['last_date'], '2015-08-13T10:20:27+02:00')
+
+    def test_sync_resumes_from_checkpoint(self, mock_logger, m):
+        '''After a restart only newer entries are requested.'''
+        m.get(requests_mock.ANY, json=self.ledger)
+        btcde.LedgerEngine(self.path, checkpoint_interval=0).sync(
+            btcde.Connection('f00b4r', 'b4rf00'), 'btc')
+        engine = btcde.LedgerEngine(self.path)
+        self.assertEqual(engine.get('btc')['balance'], Decimal('3.00019794'))
+        self.assertEqual(engine.sync(btcde.Connection('f00b4r', 'b4rf00'), 'btc'), 0)
+        self.assertIn('datetime_start=2015-08-13T10%3A20%3A27%2B02%3A00',
+                      m.request_history[1].url)
+
+    def test_sync_all_pages(self, mock_logger, m):
+        '''Entries of later (older) pages are applied as well.'''
+        entries = self.ledger['account_ledger']
+        pages = [dict(self.ledger, account_ledger=entries[:2], page={'current': 1, 'last': 2}),
+                 dict(self.ledger, account_ledger=entries[2:], page={'current': 2, 'last': 2})]
+        m.get(requests_mock.ANY, [{'json': page} for page in pages])
+        engine = btcde.LedgerEngine()
+        self.assertEqual(engine.sync(btcde.Connection('f00b4r', 'b4rf00'), 'btc'), 4)
+        state = engine.get('btc')
+        self.assertEqual(state['balance'], Decimal('3.00019794'))
+        self.assertEqual(round(state['realized'], 6), Decimal('-1.485285'))
+
+    def test_sync_failed_page_applies_nothing(self, mock_logger, m):
+        '''A window is only applied when all its pages were fetched.'''
+        first = dict(self.ledger, account_ledger=self.ledger['account_ledger'][:2],
+                     page={'current': 1, 'last': 2})
+        m.get(requests_mock.ANY, [{'json': first},
+                                  {'exc': requests.exceptions.ConnectTimeout}])
+        engine = btcde.LedgerEngine()
+        self.assertEqual(engine.sync(btcde.Connection('f00b4r', 'b4rf00'), 'btc'), 0)
+        self.assertIsNone(engine.get('btc')['last_date'])
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeAddressPoolManager(TestCase):
+    '''Tests for bulk address pool synchronisation.'''
+
+    def setUp(self):
+        with open('tests/resources/listAddressPool.json') as f:
+            self.pool = json.load(f)
+        self.existing = self.pool['addresses'][0]['address']
+        self.manager = btcde.AddressPoolManager(btcde.Connection('f00b4r', 'b4rf00'), 'btc')
+
+    def test_sync_uploads_difference(self, mock_logger, m):
+        '''Only missing addresses are added, unwanted ones removed.'''
+        m.get(requests_mock.ANY, json=self.pool)
+        m.post(requests_mock.ANY, json={'errors': [], 'credits': 8}, status_code=201)
+        m.delete(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        self.assertTrue(self.manager.refresh())
+        progress = []
+        report = self.manager.sync(['new1', 'new2'], remove_missing=True,
+                                   progress=lambda done, total: progress.append((done, total)),
+                                   comment='bulk')
+        self.assertEqual(set(report), {'new1', 'new2', self.existing})
+        methods = sorted(r.method for r in m.request_history[1:])
+        self.assertEqual(methods, ['DELETE', 'POST', 'POST'])
+        self.assertEqual(progress[-1], (3, 3))
+        self.assertEqual(set(self.manager.index), {'new1', 'new2'})
+        self.assertEqual(self.manager.sync(['new1', 'new2']), {})
+
+    def test_refresh_continues_from_last_page(self, mock_logger, m):
+        '''A refresh rereads only the last known page.'''
+        m.get(requests_mock.ANY, json=self.pool)
+        self.manager.refresh()
+        self.manager.refresh()
+        self.assertEqual(len(m.request_history), 2)
+        self.assertIn('page=1', m.request_history[1].url)
+        self.assertIn(self.existing, self.manager.index)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeSettlementQueue(TestCase):
+    '''Tests for the durable settlement settlement.'''
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'settlement.db')
+        self.conn = btcde.Connection('f00b4r', 'b4rf00')
+
+    def test_deduplicate_and_execute(self, mock_logger, m):
+        '''An action is queued once per trade and executed.'''
+        m.post(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        settlement = btcde.SettlementQueue(self.conn, self.path)
+        self.assertTrue(settlement.add('addTradeRating', 'btceur', 'T1', rating='positive'))
+        self.assertFalse(settlement.add('addTradeRating', 'btceur', 'T1', rating='positive'))
+        self.assertTrue(settlement.run_one())
+        self.assertFalse(settlement.run_one())
+        self.assertEqual(settlement.states(), {'done': 1})
+        self.assertIn('add_trade_rating', m.request_history[0].url)
+
+    def test_resume_and_retry(self, mock_logger, m):
+        '''Running actions resume after a restart, failures are retried.'''
+        with open('tests/resources/error.json') as f:
+            m.post(requests_mock.ANY, json=json.load(f), status_code=400)
+        settlement = btcde.SettlementQueue(self.conn, self.path, retry_delay=0, max_attempts=2)
+        settlement.add('markTradeAsPaid', 'btceur', 'T2', volume_currency_to_pay_after_fee=10)
+        settlement.claim()
+        settlement = btcde.SettlementQueue(self.conn, self.path, retry_delay=0, max_attempts=2)
+        self.assertEqual(settlement.states(), {'pending': 1})
+        settlement.run_one()
+        settlement.run_one()
+        self.assertEqual(settlement.states(), {'failed': 1})
+
+    def test_collect(self, mock_logger, m):
+        '''Trades needing an action are queued through the planner.'''
+        with open('tests/resources/showMyTrades.json') as f:
+            trades = json.load(f)
+        trades['trades'][0]['trading_pair'] = 'btceur'
+        trades['page'] = {'current': 1, 'last': 1}
+        m.get(requests_mock.ANY, json=trades)
+        settlement = btcde.SettlementQueue(self.conn, self.path)
+
+        def planner(trade):
+            return [('addTradeRating', {'rating': 'positive'})]
+        self.assertEqual(settlement.collect(planner), 1)
+        self.assertEqual(settlement.collect(planner), 0)
+        self.assertIn('only_trades_with_action_for_payment_or_transfer_required=1',
+                      m.request_history[0].url)
+
+    def test_no_default_planner(self, mock_logger, m):
+        '''Nothing is collected or claimed without a planner.'''
+        settlement = btcde.SettlementQueue(self.conn, self.path, workers=1)
+        with self.assertRaises(ValueError):
+            settlement.collect()
+        settlement.start()
+        settlement.stop()
+        self.assertEqual(m.request_history, [])
+        self.assertEqual(settlement.states(), {})
+
+    def test_start_collects(self, mock_logger, m):
+        '''Started queues collect candidates with their planner.'''
+        with open('tests/resources/showMyTrades.json') as f:
+            trades = json.load(f)
+        trades['trades'][0].update({'trading_pair': 'btceur', 'type': 'buy', 'state': 0,
+                                    'volume_currency_to_pay_after_fee': 125.28})
+        trades['page'] = {'current': 1, 'last': 1}
+        m.get(requests_mock.ANY, json=trades)
+        m.post(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        def planner(trade):
+            return [('markTradeAsPaid', {'volume_currency_to_pay_after_fee':
+                                         trade['volume_currency_to_pay_after_fee']})]
+        settlement = btcde.SettlementQueue(self.conn, self.path, workers=1, planner=planner)
+        settlement.start()
+        deadline = time.time() + 5
+        while settlement.states() != {'done': 1} and time.time() < deadline:
+            time.sleep(0.05)
+        settlement.stop()
+        self.assertEqual(settlement.states(), {'done': 1})
+        self.assertIn('mark_trade_as_paid', m.request_history[-1].url)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeWriteJournal(TestCase):
+    '''Tests for the write-ahead journal.'''
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'journal.log')
+        self.journal = btcde.WriteJournal(self.path)
+        self.conn = btcde.Connection('f00b4r', 'b4rf00', journal=self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+
+    def test_writes_are_journaled(self, mock_logger, m):
+        '''Intent and outcome of a write are logged, reads are not.'''
+        m.post(requests_mock.ANY, json={'order_id': 'A1', 'errors': [], 'credits': 8},
+               status_code=201)
+        m.get(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        self.conn.createOrder('buy', 'btceur', 1, 250)
+        nonce = self.conn.nonce
+        self.conn.showAccountInfo()
+        entries = self.journal.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['id'], str(nonce))
+        self.assertEqual(entries[0]['status'], 201)
+        self.assertEqual(self.journal.in_doubt(), [])
+
+    def test_recover_in_doubt(self, mock_logger, m):
+        '''Only entries without outcome are looked up after a crash.'''
+        with open('tests/resources/showMyOrderDetails.json') as f:
+            m.get(requests_mock.ANY, json=json.load(f))
+        self.journal.intent('DELETE', 'https://api.bitcoin.de/v4/btceur/orders/2EDYNS',
+                            '1', '')
+        self.journal.intent('POST', 'https://api.bitcoin.de/v4/btceur/orders/OTHER',
+                            '2', '')
+        self.journal.outcome('2', 200, b'{}')
+        self.journal.sync(self.journal.written)
+        with open(self.path, 'ab') as f:
+            f.write(b'{"id": "3", "tor')
+        journal = btcde.WriteJournal(self.path)
+        recovered = journal.recover(self.conn)
+        self.assertEqual([entry['id'] for entry, result in recovered], ['1'])
+        self.assertEqual(recovered[0][1]['order']['state'], 0)
+        self.assertEqual(m.request_history[0].url,
+                         'https://api.bitcoin.de/v4/btceur/orders/2EDYNS')
+        self.assertEqual(journal.in_doubt(), [])
+        journal.compact()
+        self.assertEqual(journal.entries(), [])
+        journal.close()
+
+    def test_recover_trades(self, mock_logger, m):
+        '''executeTrade is looked up by time, settlement actions by trade_id.'''
+        with open('tests/resources/showMyTrades.json') as f:
+            m.get('https://api.bitcoin.de/v4/btceur/trades', json=json.load(f))
+        with open('tests/resources/showMyTradeDetails.json') as f:
+            m.get('https://api.bitcoin.de/v4/btceur/trades/T1', json=json.load(f))
+        self.journal.intent('POST', 'https://api.bitcoin.de/v4/btceur/trades/OFFER1', '1', '')
+        self.journal.intent('POST', 'https://api.bitcoin.de/v4/btceur/trades/T1/mark_trade_as_paid',
+                            '2', '')
+        recovered = self.journal.recover(self.conn)
+        self.assertEqual(recovered[0][1]['trades'][0]['trade_id'], '2EDYNS')
+        self.assertNotIn('OFFER1', m.request_history[0].url)
+        self.assertIn('date_start=', m.request_history[0].url)
+        self.assertIn('date_end=', m.request_history[0].url)
+        self.assertEqual(m.request_history[1].path, '/v4/btceur/trades/t1')
+        self.assertEqual(self.journal.in_doubt(), [])
+
+    def test_compact_keeps_concurrent_intents(self, mock_logger, m):
+        '''Intents logged while compacting are not lost.'''
+        url = 'https://api.bitcoin.de/v4/btceur/orders'
+
+        def write(n):
+            for i in range(50):
+                self.journal.intent('POST', url, f'{n}-{i}', '')
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            writers = [executor.submit(write, n) for n in range(3)]
+            while not all(w.done() for w in writers):
+                self.journal.compact()
+        self.assertEqual(len(self.journal.in_doubt()), 150)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeStateSnapshot(TestCase):
+    '''Tests for warm-start snapshots.'''
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'state.snap')
+
+    def test_components_round_trip(self, mock_logger, m):
+        '''Registered components get their state back after a restart.'''
+        m.post(requests_mock.ANY, json={'order_id': 'A1', 'errors': [], 'credits': 8},
+               status_code=201)
+        conn = btcde.Connection('f00b4r', 'b4rf00')
+        snapshot = btcde.StateSnapshot(self.path)
+        snapshot.register('conn', conn)
+        tracker = snapshot.register('orders', btcde.OrderTracker(conn))
+        tracker.createOrder('buy', 'btceur', 1, 250)
+        candles = snapshot.register('candles', btcde.CandleBuilder())
+        candles.add_trades('btceur', [{'date': 60, 'price': 1, 'amount': '1', 'tid': 7}])
+        snapshot.close()
+
+        conn = btcde.Connection('f00b4r', 'b4rf00')
+        conn.nonce = 0
+        restored = btcde.StateSnapshot(self.path)
+        validated = threading.Event()
+        restored.register('conn', conn)
+        tracker = restored.register('orders', btcde.OrderTracker(conn),
+                                    validate=validated.set)
+        candles = restored.register('candles', btcde.CandleBuilder())
+        self.assertTrue(validated.wait(1))
+        self.assertGreater(conn.nonce, 0)
+        self.assertEqual(conn.credits, 8)
+        self.assertEqual([o['order_id'] for o in tracker.open_orders('btceur')], ['A1'])
+        self.assertEqual(candles.last_tid('btceur'), 7)
+
+    def test_cached_values_revalidate(self, mock_logger, m):
+        '''Cached results are served from the snapshot and refreshed once.'''
+        with open('tests/resources/showPermissions.json') as f:
+            m.get(requests_mock.ANY, json=json.load(f))
+        conn = btcde.Connection('f00b4r', 'b4rf00')
+        snapshot = btcde.StateSnapshot(self.path)
+        snapshot.cached('permissions', conn.showPermissions)
+        snapshot.save()
+        restored = btcde.StateSnapshot(self.path)
+        self.assertIn('createOrder', restored.cached('permissions', conn.showPermissions)['permissions'])
+        restored.cached('permissions', conn.showPermissions)
+        for _ in range(100):
+            if len(m.request_history) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(m.request_history), 2)
+
+    def test_saves_copies_while_updating(self, mock_logger, m):
+        '''Components keep changing while being saved, failures are logged.'''
+        graph = btcde.RateGraph()
+        state = graph.snapshot_state()
+        graph.update('btceur', 20000, 20000)
+        self.assertEqual(state['spreads'], {})
+        self.assertEqual(state['rates'][graph.index['btc']][graph.index['eur']], 0.0)
+        snapshot = btcde.StateSnapshot(self.path)
+        snapshot.register('graph', graph)
+        snapshot.register('broken', btcde.RateGraph())
+        snapshot.components['broken'].snapshot_state = lambda: 1 / 0
+        snapshot.running = True
+        thread = threading.Thread(target=snapshot.run, args=(0.01,))
+        thread.start()
+        for _ in range(100):
+            if mock_logger.warning.called:
+                break
+            time.sleep(0.01)
+        snapshot.running = False
+        thread.join()
+        self.assertTrue(mock_logger.warning.called)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeConnectionManager(TestCase):
+    '''Tests for multi-account scheduling.'''
+
+    def setUp(self):
+        self.manager = btcde.ConnectionManager(workers=1)
+        self.alice = self.manager.add_account('alice', 'k1', 's1')
+        self.bob = self.manager.add_account('bob', 'k2', 's2', min_credits=10)
+
+    def test_shared_session_own_nonces(self, mock_logger, m):
+        '''Accounts share the transport but sign with their own keys.'''
+        self.assertIs(self.alice.session, self.bob.session)
+        m.get(requests_mock.ANY, json={'errors': [], 'credits': 20})
+        self.manager.start()
+        futures = [self.manager.submit(name, 'showPermissions') for name in ('alice', 'bob')]
+        for future in futures:
+            self.assertEqual(future.result(timeout=5)['credits'], 20)
+        self.manager.stop()
+        self.assertEqual(sorted(r.headers['X-API-KEY'] for r in m.request_history),
+                         ['k1', 'k2'])
+
+    def test_round_robin(self, mock_logger, m):
+        '''Queued calls alternate between accounts.'''
+        for _ in range(2):
+            self.manager.submit('alice', 'showPermissions')
+        self.manager.submit('bob', 'showPermissions')
+        order = []
+        while True:
+            job = self.manager.next_job()
+            if job is None:
+                break
+            order.append(job[1].__self__)
+        self.assertEqual(order, [self.alice, self.bob, self.alice])
+
+    def test_credit_budget(self, mock_logger, m):
+        '''An account below its credit budget is skipped for a while.'''
+        self.bob.credits = 5
+        self.manager.submit('bob', 'showPermissions')
+        self.manager.last_call['bob'] = time.monotonic()
+        self.assertIsNone(self.manager.next_job())
+        self.manager.last_call['bob'] = 0
+        self.assertIsNotNone(self.manager.next_job())
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeRequestScheduler(TestCase):
+    '''Tests for the priority request scheduler.'''
+
+    def setUp(self):
+        self.conn = btcde.Connection('f00b4r', 'b4rf00')
+        self.scheduler = btcde.RequestScheduler(self.conn, workers=1,
+                                                queue_sizes={'reporting': 1})
+
+    def test_priority_order(self, mock_logger, m):
+        '''Cancels run before queued reporting and market data.'''
+        self.scheduler.submit('showAccountLedger', 'btc')
+        self.scheduler.submit('showRates', 'btceur')
+        self.scheduler.submit('deleteOrder', 'A1', 'btceur')
+        names = [self.scheduler.next_job()[2].__name__ for _ in range(3)]
+        self.assertEqual(names, ['deleteOrder', 'showRates', 'showAccountLedger'])
+
+    def test_load_shedding(self, mock_logger, m):
+        '''Full queues and passed deadlines drop requests.'''
+        self.scheduler.submit('showAccountInfo')
+        with self.assertRaises(btcde.RequestDropped):
+            self.scheduler.submit('showPermissions').result()
+        stale = self.scheduler.submit('showRates', 'btceur', deadline=-1)
+        self.scheduler.next_job()
+        with self.assertRaises(btcde.RequestDropped):
+            stale.result()
+
+    def test_reads_wait_without_credits(self, mock_logger, m):
+        '''Below min_credits reads wait for credit_wait after the last call.'''
+        self.conn.credits, self.conn.min_credits = 1, 5
+        self.scheduler.credit_wait = 0.05
+        self.scheduler.last_call = time.monotonic()
+        self.scheduler.submit('showRates', 'btceur')
+        self.scheduler.submit('deleteOrder', 'A1', 'btceur')
+        self.assertEqual(self.scheduler.next_job()[2].__name__, 'deleteOrder')
+        self.assertIsNone(self.scheduler.next_job())
+        time.sleep(0.06)
+        self.assertEqual(self.scheduler.next_job()[2].__name__, 'showRates')
+
+    def test_held_back_reads_expire(self, mock_logger, m):
+        '''Deadlines are enforced in queues which are not served.'''
+        self.conn.credits, self.conn.min_credits = 1, 5
+        self.scheduler.last_call = time.monotonic()
+        future = self.scheduler.submit('showRates', 'btceur', deadline=0)
+        time.sleep(0.01)
+        self.assertIsNone(self.scheduler.next_job())
+        with self.assertRaises(btcde.RequestDropped):
+            future.result(timeout=0)
+
+    def test_cancel_all_uses_scheduler(self, mock_logger, m):
+        '''Write helpers of the connection run through the scheduler.'''
+        m.delete(requests_mock.ANY, json={'errors': [], 'credits': 8})
+        self.conn.scheduler = self.scheduler
+        self.scheduler.start()
+        report = self.conn.delete_orders([('A1', 'btceur')])
+        self.scheduler.stop()
+        self.assertEqual(report['A1']['credits'], 8)
+
+
+class TestBtcdeOrderbookHistory(TestCase):
+    '''Tests for keyframe and delta order book storage.'''
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'btceur.obh')
+        with open('tests/resources/showOrderbookCompact.json') as f:
+            self.book = json.load(f, parse_float=Decimal)
+
+    def book_at(self, bid):
+        book = json.loads(json.dumps(self.book, default=str), parse_float=Decimal)
+        book['orders']['bids'][1]['price'] = Decimal(bid)
+        return book
+
+    def test_reconstruct_any_time(self):
+        '''Books are rebuilt from the nearest keyframe and its deltas.'''
+        writer = btcde.OrderbookHistoryWriter(self.path, 'btceur', keyframe_interval=10)
+        for second in range(25):
+            writer.append(1000 + second, self.book_at(str(205 + second)))
+        writer.close()
+        reader = btcde.OrderbookHistoryReader(self.path)
+        self.assertEqual(reader.times, [1000, 1010, 1020])
+        self.assertIsNone(reader.at(999))
+        levels = reader.at(1013.5)
+        self.assertIn(Decimal('218'), levels['bids'])
+        self.assertEqual(len(levels['bids']), 2)
+        self.assertEqual(btcde.levels_to_orderbook(levels)['asks'][0]['price'], 250)
+        scanned = [(t, max(levels['bids'])) for t, levels in reader.scan(1018, 1021)]
+        self.assertEqual(scanned, [(1018, 223), (1019, 224), (1020, 225), (1021, 226)])
+        reader.close()
+
+    def test_unchanged_books_are_not_stored(self):
+        '''Only changes are written between keyframes.'''
+        writer = btcde.OrderbookHistoryWriter(self.path, 'btceur')
+        for second in range(5):
+            writer.append(second, self.book)
+        writer.close()
+        reader = btcde.OrderbookHistoryReader(self.path)
+        self.assertEqual(len(list(reader.records())), 1)
+        reader.close()
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeBulkExporter(TestCase):
+    '''Tests for the bulk export.'''
+
+    def setUp(self):
+        self.conn = btcde.Connection('abc', 'def')
+        self.directory = tempfile.mkdtemp()
+        self.fail_page = None
+        self.credits = 20
+
+    def pages(self, key, last):
+        def callback(request, context):
+            page = int(request.qs['page'][0])
+            if page == self.fail_page:
+                context.status_code = 500
+                return {'errors': [{'code': 500, 'message': 'Internal error'}]}
+            entry = {'id': f'{key}{page}', 'detail': {'page': page}}
+            if page == 2:
+                entry['fee'] = '0.1'
+            return {key: [entry], 'page': {'current': page, 'last': last},
+                    'errors': [], 'credits': self.credits}
+        return callback
+
+    def register(self, m):
+        m.get(self.conn.apibase + 'trades', json=self.pages('trades', 3))
+        m.get(self.conn.apibase + 'orders', json=self.pages('orders', 1))
+        m.get(self.conn.apibase + 'btc/account/ledger',
+              json=self.pages('account_ledger', 2))
+
+    def test_export_and_resume(self, mock_logger, m):
+        '''An interrupted export continues after the last saved page.'''
+        self.register(m)
+        self.fail_page = 3
+        progress = []
+        exporter = btcde.BulkExporter(self.conn, self.directory, currencies=['btc'],
+                                      progress=lambda *args: progress.append(args))
+        self.assertEqual(exporter.run(),
+                         {'trades': False, 'orders': True, 'ledger_btc': True})
+        self.assertIn(('ledger_btc', 2, 2, 2), [p[:4] for p in progress])
+        self.fail_page = None
+        m.reset_mock()
+        exporter = btcde.BulkExporter(self.conn, self.directory, currencies=['btc'])
+        self.assertTrue(all(exporter.run().values()))
+        self.assertEqual([r.qs['page'] for r in m.request_history], [['3']])
+        # the end date of the first run is kept on resume
+        with open(os.path.join(self.directory, 'trades.state')) as f:
+            end = json.load(f)['end']
+        self.assertEqual(m.request_history[0].qs['date_end'], [end.lower()])
+        trades = list(btcde.read_export(exporter.path('trades')))
+        self.assertEqual([t['id'] for t in trades], ['trades1', 'trades2', 'trades3'])
+        orders = list(btcde.read_export(exporter.path('orders')))
+        self.assertEqual(len(orders), 3)
+
+    def test_csv(self, mock_logger, m):
+        '''Nested fields become dotted columns.'''
+        self.register(m)
+        exporter = btcde.BulkExporter(self.conn, self.directory, currencies=['btc'],
+                                      format='csv')
+        exporter.run()
+        rows = list(btcde.read_export(exporter.path('ledger_btc')))
+        self.assertEqual(rows, [{'detail.page': '1', 'fee': '', 'id': 'account_ledger1'},
+                                {'detail.page': '2', 'fee': '0.1', 'id': 'account_ledger2'}])
+        self.assertEqual(sorted(os.listdir(self.directory))[:3],
+                         ['ledger_btc.csv.gz', 'ledger_btc.state', 'orders.csv.gz'])
+
+    def test_low_credits(self, mock_logger, m):
+        '''Below min_credits pages are only delayed, which refreshes the credits.'''
+        self.register(m)
+        self.credits = 4
+        self.conn.min_credits = 5
+        exporter = btcde.BulkExporter(self.conn, self.directory, currencies=['btc'],
+                                      credit_wait=0.01)
+        self.assertTrue(all(exporter.run().values()))
+        self.assertEqual(len(m.request_history), 8)
+        ledger = [r.qs for r in m.request_history if 'ledger' in r.url]
+        self.assertEqual(len({qs['datetime_end'][0] for qs in ledger}), 1)
+
+    def test_main_requires_credentials(self, mock_logger, m):
+        '''The command line refuses to run without API credentials.'''
+        with patch.dict(os.environ, {}, clear=True):
+            with self.assertRaises(SystemExit):
+                btcde.main(['export', self.directory])
+
+
+class TestBtcdePrewarm(TestCase):
+    '''Tests for connection pre-warming and the DNS cache.'''
+
+    def setUp(self):
+        import http.server
+        self.peers = []
+        self.heads = []
+        test = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                test.peers.append(self.client_address)
+
+            def do_HEAD(self):
+                test.heads.append(self.client_address)
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        resolver = patch('btcde.socket.getaddrinfo', return_value=[
+            (2, 1, 6, '', ('127.0.0.1', self.server.server_port))])
+        self.getaddrinfo = resolver.start()
+        self.addCleanup(resolver.stop)
+        self.conn = btcde.Connection('abc', 'def', pool_size=3, dns_ttl=60)
+        self.conn.session.mount('http://', self.conn.session.get_adapter('https://'))
+        self.conn.apihost = 'http://localhost:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.conn.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_prewarm_and_ping(self):
+        '''Sockets are opened once and kept busy by pings.'''
+        self.assertEqual(self.conn.prewarm(), 3)
+        self.assertEqual(len(self.peers), 3)
+        self.assertEqual(self.conn.prewarm(ping=True), 3)
+        self.assertEqual(len(self.peers), 3)
+        self.assertEqual(sorted(self.heads), sorted(self.peers))
+
+    def lookups(self):
+        return len([c for c in self.getaddrinfo.call_args_list if c.args[0] == 'localhost'])
+
+    def test_dns_cache(self):
+        '''The host is resolved once for all sockets within the ttl.'''
+        self.conn.prewarm()
+        self.assertEqual(self.lookups(), 1)
+        cache = self.conn.session.get_adapter('https://').dns_cache
+        self.assertEqual(cache.resolve('localhost', self.server.server_port), '127.0.0.1')
+        self.assertEqual(self.lookups(), 1)
+        cache.ttl = 0
+        cache.resolve('localhost', self.server.server_port)
+        self.assertEqual(self.lookups(), 2)
+
+
+@patch('btcde.log')
+@requests_mock.Mocker()
+class TestBtcdeStrictMode(TestCase):
+    '''Tests for classified exceptions in strict mode.'''
+
+    def setUp(self):
+        self.conn = btcde.Connection('abc', 'def', strict=True)
+        self.url = self.conn.apibase + 'account'
+
+    def error(self, m, status_code, message, code=1, **args):
+        m.get(self.url, status_code=status_code,
+              json={'errors': [{'message': message, 'code': code}]}, **args)
+
+    def test_classification(self, mock_logger, m):
+        '''Error responses raise the matching exception class.'''
+        cases = [(429, 'Insufficient credits', btcde.CreditsExhausted),
+                 (401, 'Invalid nonce', btcde.NonceError),
+                 (401, 'Invalid signature', btcde.AuthenticationError),
+                 (422, 'Invalid value', btcde.ValidationError),
+                 (503, 'Technical reason', btcde.ServerError)]
+        for status_code, message, cls in cases:
+            self.error(m, status_code, message, code=status_code)
+            with self.assertRaises(cls) as context:
+                self.conn.showAccountInfo()
+            self.assertIs(type(context.exception), cls)
+            self.assertEqual(context.exception.codes, [status_code])
+            self.assertEqual(context.exception.status_code, status_code)
+
+    def test_retry_hints(self, mock_logger, m):
+        '''Retry-After is passed on, validation errors are final.'''
+        self.error(m, 429, 'Insufficient credits', headers={'Retry-After': '30'})
+        with self.assertRaises(btcde.APIError) as context:
+            self.conn.showAccountInfo()
+        self.assertTrue(context.exception.retry)
+        self.assertEqual(context.exception.retry_after, 30)
+        self.error(m, 400, 'Order not found', code=13)
+        with self.assertRaises(ValueError) as context:
+            self.conn.showAccountInfo()
+        self.assertFalse(context.exception.retry)
+
+    def test_non_json_body(self, mock_logger, m):
+        '''Non UTF-8 and non JSON bodies do not break error parsing.'''
+        with open('tests/resources/NonUTF8') as f:
+            m.get(self.url, content=f.read().encode('utf-16', 'replace'), status_code=403)
+        with self.assertRaises(btcde.AuthenticationError) as context:
+            self.conn.showAccountInfo()
+        self.assertEqual(context.exception.codes, [51])
+        m.get(self.url, text='<html>Bad Gateway</html>', status_code=502)
+        with self.assertRaises(btcde.ServerError) as context:
+            self.conn.showAccountInfo()
+        self.assertEqual(context.exception.errors, [])
+        self.conn.strict = False
+        self.assertEqual(self.conn.showAccountInfo(), {})
+
+    def test_network_error(self, mock_logger, m):
+        '''Requests that did not get through are transient.'''
+        m.get(self.url, exc=requests.exceptions.ConnectTimeout)
+        with self.assertRaises(btcde.TransientError) as context:
+            self.conn.showAccountInfo()
+        self.assertTrue(context.exception.retry)